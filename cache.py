@@ -0,0 +1,149 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+
+
+def file_hash(path):
+    # sha256 of the file content, so renamed or copied files share entries
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def make_key(*parts):
+    # one key for any json-serializable combination of settings
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def files_version(paths):
+    # cheap identity of the content of some files: name, size and modification time
+    return make_key(sorted(
+        (os.path.basename(path), os.path.getsize(path), os.stat(path).st_mtime_ns) for path in paths))
+
+
+def write_atomic(path, write):
+    # write(f) to a temporary file of its own, then move it into place, so
+    # readers never see half a file and concurrent writers never collide
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def entry_bytes(entry):
+    return sum(value.nbytes for value in entry.values())
+
+
+class PromptCache(object):
+    # encoded prompts with their post-prefill logits and memory.
+    # an entry is a dict of numpy arrays; the least recently used entries are
+    # kept in RAM up to max_bytes and spilled to cache_dir (if given), which is
+    # in turn trimmed to max_disk_bytes by dropping the least recently used files
+    def __init__(self, max_bytes=1 << 30, cache_dir=None, max_disk_bytes=8 << 30):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def __contains__(self, key):
+        return key in self.entries or (self.cache_dir is not None and os.path.exists(self.path(key)))
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if self.cache_dir is None or not os.path.exists(self.path(key)):
+            return None
+        try:
+            with np.load(self.path(key)) as f:
+                entry = {name: f[name] for name in f.files}
+        except (OSError, ValueError) as err:
+            print(f"dropping unreadable cache file {self.path(key)}: {err}")
+            os.remove(self.path(key))
+            return None
+        # mark as recently used on disk too
+        os.utime(self.path(key))
+        self.remember(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        if key in self.entries:
+            self.nbytes -= entry_bytes(self.entries.pop(key))
+        self.remember(key, entry)
+
+    def remember(self, key, entry):
+        self.entries[key] = entry
+        self.nbytes += entry_bytes(entry)
+        while self.nbytes > self.max_bytes and self.entries:
+            old_key, old_entry = self.entries.popitem(last=False)
+            self.nbytes -= entry_bytes(old_entry)
+            self.spill(old_key, old_entry)
+
+    def spill(self, key, entry):
+        if self.cache_dir is None or os.path.exists(self.path(key)):
+            return
+        write_atomic(self.path(key), lambda f: np.savez(f, **entry))
+        self.trim()
+
+    def trim(self):
+        files = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith('.npz')]
+        files.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(path) for path in files)
+        for path in files:
+            if total <= self.max_disk_bytes:
+                break
+            total -= os.path.getsize(path)
+            os.remove(path)
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+        if self.cache_dir is not None:
+            for name in os.listdir(self.cache_dir):
+                if name.endswith('.npz'):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+
+class TokenCache(object):
+    # word ids of encoded midi files, one compact .npy file per key
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.npy')
+
+    def get(self, key):
+        if not os.path.exists(self.path(key)):
+            return None
+        try:
+            return np.load(self.path(key))
+        except (OSError, ValueError) as err:
+            print(f"dropping unreadable cache file {self.path(key)}: {err}")
+            os.remove(self.path(key))
+            return None
+
+    def put(self, key, words):
+        words = np.asarray(words)
+        dtype = np.int16 if words.size == 0 or words.max() < np.iinfo(np.int16).max else np.int32
+        os.makedirs(os.path.dirname(self.path(key)), exist_ok=True)
+        write_atomic(self.path(key), lambda f: np.save(f, words.astype(dtype)))
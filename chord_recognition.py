@@ -2,6 +2,9 @@ import miditoolkit
 import numpy as np
 
 class MIDIChord(object):
+    # see chord_table
+    TABLE = None
+
     def __init__(self):
         # define pitch classes
         self.PITCH_CLASSES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
@@ -87,40 +90,7 @@ class MIDIChord(object):
         return scores, qualities
 
     def find_chord(self, pianoroll):
-        chroma = miditoolkit.pianoroll.utils.tochroma(pianoroll=pianoroll)
-        chroma = np.sum(chroma, axis=0)
-        chroma = np.array([1 if c else 0 for c in chroma])
-        if np.sum(chroma) == 0:
-            return 'N', 'N', 'N', 0
-        else:
-            candidates = self.sequencing(chroma=chroma)
-            scores, qualities = self.scoring(candidates=candidates)
-            # bass note
-            sorted_notes = []
-            for i, v in enumerate(np.sum(pianoroll, axis=0)):
-                if v > 0:
-                    sorted_notes.append(int(i%12))
-            bass_note = sorted_notes[0]
-            # root note
-            __root_note = []
-            _max = max(scores.values())
-            for _root_note, score in scores.items():
-                if score == _max:
-                    __root_note.append(_root_note)
-            if len(__root_note) == 1:
-                root_note = __root_note[0]
-            else:
-                #TODO: what should i do
-                for n in sorted_notes:
-                    if n in __root_note:
-                        root_note = n
-                        break
-            # quality
-            quality = qualities.get(root_note)
-            sequence = candidates.get(root_note)
-            # score
-            score = scores.get(root_note)
-            return self.PITCH_CLASSES[root_note], quality, self.PITCH_CLASSES[bass_note], score
+        return self.find_chords(np.sum(pianoroll, axis=0)[None] > 0)[0]
 
     def greedy(self, candidates, max_tick, min_length):
         chords = []
@@ -154,33 +124,97 @@ class MIDIChord(object):
                 temp2[-1][1] = chord[1]
         return temp2
 
+    def beat_activity(self, start, end, pitch, velocity, max_tick, ticks_per_beat):
+        # [n_beats, 128], True where a pitch sounds somewhere in the beat.
+        # the same notes as the tick pianoroll: silent notes are skipped and
+        # notes with zero length last one tick
+        keep = velocity > 0
+        start, end, pitch = start[keep], np.maximum(end[keep], start[keep] + 1), pitch[keep]
+        n_beats = -(-max_tick // ticks_per_beat)
+        first = start // ticks_per_beat
+        last = np.minimum((end - 1) // ticks_per_beat, n_beats - 1)
+        keep = first < n_beats
+        # +1 on the first beat of a note, -1 after its last beat
+        diff = np.zeros((n_beats + 1, 128), dtype=np.int64)
+        np.add.at(diff, (first[keep], pitch[keep]), 1)
+        np.add.at(diff, (last[keep] + 1, pitch[keep]), -1)
+        return np.cumsum(diff, axis=0)[:-1] > 0
+
+    def chroma_codes(self, active):
+        # active: [n, 128] -> 12-bit chroma code and the lowest active pitch of
+        # every pitch class (128 if the class is silent), [n] and [n, 12]
+        padded = np.zeros((len(active), 132), dtype=bool)
+        padded[:, :128] = active
+        octaves = padded.reshape(-1, 11, 12)
+        chroma = octaves.any(axis=1)
+        codes = chroma.dot(1 << np.arange(12))
+        lowest = np.where(chroma, np.argmax(octaves, axis=1) * 12 + np.arange(12), 128)
+        return codes, lowest
+
+    def score_codes(self, codes):
+        # scores and qualities of every root for each chroma code;
+        # roots that are not in the chroma score -inf
+        scores = np.full((len(codes), 12), -np.inf)
+        qualities = np.full((len(codes), 12), 'None', dtype=object)
+        for i, code in enumerate(codes):
+            chroma = (code >> np.arange(12)) & 1
+            _scores, _qualities = self.scoring(candidates=self.sequencing(chroma=chroma))
+            for root_note, score in _scores.items():
+                scores[i, root_note] = score
+                qualities[i, root_note] = _qualities[root_note]
+        return scores, qualities
+
+    def chord_table(self):
+        # scores, qualities and best roots of all 4096 chroma codes, built once
+        if MIDIChord.TABLE is None:
+            scores, qualities = self.score_codes(np.arange(4096))
+            best = scores == scores.max(axis=1, keepdims=True)
+            MIDIChord.TABLE = scores, qualities, best
+        return MIDIChord.TABLE
+
+    def find_chords(self, active):
+        # find_chord for many windows at once, active: [n_windows, 128]
+        codes, lowest = self.chroma_codes(active)
+        scores, qualities, best = self.chord_table()
+        # best root, ties go to the root with the lowest note
+        root_notes = np.argmin(np.where(best[codes], lowest, 129), axis=1)
+        bass_notes = np.argmin(lowest, axis=1)
+        chords = []
+        for code, root_note, bass_note, quality, score in zip(
+                codes, root_notes, bass_notes, qualities[codes, root_notes], scores[codes, root_notes]):
+            if code == 0:
+                chords.append(('N', 'N', 'N', 0))
+            else:
+                chords.append((self.PITCH_CLASSES[root_note], quality, self.PITCH_CLASSES[bass_note], int(score)))
+        return chords
+
     def extract(self, notes):
+        return self.extract_arrays(
+            start=np.array([n.start for n in notes], dtype=np.int64),
+            end=np.array([n.end for n in notes], dtype=np.int64),
+            pitch=np.array([n.pitch for n in notes], dtype=np.int64),
+            velocity=np.array([n.velocity for n in notes], dtype=np.int64))
+
+    def extract_arrays(self, start, end, pitch, velocity):
         # read
-        max_tick = max([n.end for n in notes])
+        max_tick = int(np.max(end))
         ticks_per_beat = 480
-        pianoroll = self.note2pianoroll(
-            notes=notes, 
-            max_tick=max_tick, 
-            ticks_per_beat=ticks_per_beat)
+        # windows are whole beats, so work on beats instead of ticks
+        active = self.beat_activity(start, end, pitch, velocity, max_tick, ticks_per_beat)
+        counts = np.concatenate([np.zeros((1, 128), dtype=np.int64), np.cumsum(active, axis=0)])
+        n_beats = len(active)
         # get lots of candidates
         candidates = {}
         # the shortest: 2 beat, longest: 4 beat
         for interval in [4, 2]:
-            for start_tick in range(0, max_tick, ticks_per_beat):
-                # set target pianoroll
-                end_tick = int(ticks_per_beat * interval + start_tick)
-                if end_tick > max_tick:
-                    end_tick = max_tick
-                _pianoroll = pianoroll[start_tick:end_tick, :]
-                # find chord
-                root_note, quality, bass_note, score = self.find_chord(pianoroll=_pianoroll)
+            first_beat = np.arange(n_beats)
+            last_beat = np.minimum(first_beat + interval, n_beats)
+            chords = self.find_chords(counts[last_beat] - counts[first_beat] > 0)
+            for beat, chord in zip(first_beat.tolist(), chords):
+                start_tick = beat * ticks_per_beat
+                end_tick = min(start_tick + ticks_per_beat * interval, max_tick)
                 # save
-                if start_tick not in candidates:
-                    candidates[start_tick] = {}
-                    candidates[start_tick][end_tick] = (root_note, quality, bass_note, score)
-                else:
-                    if end_tick not in candidates[start_tick]:
-                        candidates[start_tick][end_tick] = (root_note, quality, bass_note, score)
+                candidates.setdefault(start_tick, {}).setdefault(end_tick, chord)
         # greedy
         chords = self.greedy(candidates=candidates, 
                              max_tick=max_tick, 
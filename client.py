@@ -0,0 +1,39 @@
+import argparse
+import base64
+import json
+import urllib.error
+import urllib.request
+
+
+def generate(url, n_target_bar=16, temperature=1.2, topk=5, prompt=None):
+    # send one request to server.py and return its response (midi is base64)
+    body = json.dumps({
+        'n_target_bar': n_target_bar,
+        'temperature': temperature,
+        'topk': topk,
+        'prompt': prompt}).encode('utf-8')
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as err:
+        raise RuntimeError('{}: {}'.format(err.code, json.loads(err.read()).get('error')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Request a generation from server.py.')
+    parser.add_argument('--url', default='http://127.0.0.1:8000/generate')
+    parser.add_argument('--n-target-bar', type=int, default=16)
+    parser.add_argument('--temperature', type=float, default=1.2)
+    parser.add_argument('--topk', type=int, default=5)
+    parser.add_argument('--prompt', default=None)
+    parser.add_argument('--output', default='./result/from_server.midi')
+    args = parser.parse_args()
+
+    result = generate(args.url, args.n_target_bar, args.temperature, args.topk, args.prompt)
+    with open(args.output, 'wb') as f:
+        f.write(base64.b64decode(result['midi']))
+    print(f"Written midi to {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import argparse
+import multiprocessing
+import os
+import pickle
+import time
+import numpy as np
+import cache
+import transpose
+import utils
+
+
+# midi file -> items -> word ids, without tensorflow so it can run in worker
+# processes. holds the encoding settings of a PopMusicTransformer
+class Tokenizer(object):
+    def __init__(self, event2word, use_chords=True, transpose_input_midi_to_key=None, token_cache=None):
+        self.event2word = event2word
+        self.use_chords = use_chords
+        self.transpose_input_midi_to_key = transpose_input_midi_to_key
+        # cache.TokenCache for the word ids of encoded midi files
+        self.token_cache = token_cache
+        self.dictionary_version = cache.make_key(sorted(self.event2word.items()))
+        self.encoder = utils.REMIEncoder(self.event2word)
+
+    def extract_items(self, input_path, transposition_steps=0):
+        # quantized notes, chords and beat-level tempos, and the end of the last note
+        note_items, tempo_items = utils.read_item_arrays(input_path)
+        if self.transpose_input_midi_to_key:
+            transposition_steps = transpose.get_number_of_steps_for_transposition_to(
+                input_path, self.transpose_input_midi_to_key, notes=note_items)
+        if transposition_steps != 0:
+            print("Transposing {} steps to {}.".format(transposition_steps, self.transpose_input_midi_to_key))
+            note_items = utils.transpose_items(note_items, transposition_steps)
+        note_items = utils.quantize_items(note_items)
+        max_time = note_items[-1].end
+        if self.use_chords:
+            chord_items = utils.extract_chords(note_items)
+            items = chord_items + tempo_items + note_items
+        else:
+            items = tempo_items + note_items
+        return items, max_time
+
+    def extract_events(self, input_path, transposition_steps=0):
+        items, max_time = self.extract_items(input_path, transposition_steps)
+        groups = utils.group_items(items, max_time)
+        events = utils.item2event(groups)
+        return events
+
+    def extract_words(self, input_path, transposition_steps=0):
+        # extract_events as word ids, encoded straight from the items; read
+        # from self.token_cache when the file was encoded before with the
+        # same settings
+        key = None
+        if self.token_cache is not None:
+            key = cache.make_key(
+                cache.file_hash(input_path), transposition_steps, self.transpose_input_midi_to_key,
+                self.use_chords, self.dictionary_version, utils.encoding_params())
+            words = self.token_cache.get(key)
+            if words is not None:
+                return words.tolist()
+        items, max_time = self.extract_items(input_path, transposition_steps)
+        words = self.encoder.encode(items, max_time).tolist()
+        if key is not None:
+            try:
+                self.token_cache.put(key, words)
+            except OSError as err:
+                # the words are still good, only the cache entry is lost
+                print(f"could not cache words of {input_path}: {err}")
+        return words
+
+
+# words to training segments of group_size consecutive (x, y) pairs, read
+# forwards and backwards: [n, group_size, 2, x_len]
+def make_segments(words, x_len, group_size):
+    segments = []
+    pairs = []
+    for i in range(0, len(words) - x_len - 1, x_len):
+        x = words[i:i + x_len]
+        y = words[i + 1:i + x_len + 1]
+        pairs.append([x, y])
+    pairs = np.array(pairs)
+    # abandon the last
+    for i in np.arange(0, len(pairs) - group_size, group_size * 2):
+        data = pairs[i:i + group_size]
+        if len(data) == group_size:
+            segments.append(data)
+
+    # Create reverse segments
+    pairs = []
+    for i in range(len(words) - 1, x_len, -x_len):
+        x = words[i - x_len - 1:i - 1]
+        y = words[i - x_len:i]
+        pairs.append([x, y])
+    pairs = np.array(pairs[::-1])
+    # abandon the last
+    for i in np.arange(0, len(pairs) - group_size, group_size * 2):
+        data = pairs[i:i + group_size]
+        if len(data) == group_size:
+            segments.append(data)
+    return segments
+
+
+
+# shift segments [batch, group_size, 2 (x, y), x_len] from make_segments by a
+# word remap table (see PopMusicTransformer.create_transposition_tables).
+# drum notes keep their pitch: a Note On is a drum note when Instrument_128
+# follows two words later. Note Ons in the last two words of a segment have
+# their instrument outside of it and keep their pitch as well
+def transpose_segments(segments, table, event2word):
+    batch_size, group_size, _, x_len = segments.shape
+    # every segment is one contiguous stretch of words
+    stream = np.concatenate([segments[:, :, 0, :].reshape(batch_size, -1), segments[:, -1, 1, -1:]], axis=1)
+    transposed = table[stream]
+    drum = event2word.get('Instrument_128')
+    if drum is not None:
+        keep = np.isin(stream, [w for e, w in event2word.items() if e.startswith('Note On_')])
+        keep[:, :-2] &= stream[:, 2:] == drum
+        transposed = np.where(keep, stream, transposed)
+    return np.stack([
+        transposed[:, :-1].reshape(batch_size, group_size, x_len),
+        transposed[:, 1:].reshape(batch_size, group_size, x_len)], axis=2)
+
+########################################
+# workers
+########################################
+worker_settings = None
+
+
+def init_worker(tokenizer, x_len, group_size):
+    global worker_settings
+    worker_settings = tokenizer, x_len, group_size
+
+
+def process_file(path):
+    # (path, segments, error): one broken file only loses its own segments
+    tokenizer, x_len, group_size = worker_settings
+    try:
+        words = tokenizer.extract_words(path)
+        return path, make_segments(words, x_len, group_size), None
+    except Exception as e:
+        return path, [], '{}: {}'.format(type(e).__name__, e)
+
+
+def process_files(paths):
+    return [process_file(path) for path in paths]
+
+
+def stop_executor(executor):
+    # cancel the queued work and kill the workers rather than wait for them
+    # (ProcessPoolExecutor has no public way to terminate its processes)
+    processes = list((getattr(executor, '_processes', None) or {}).values())
+    executor.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.terminate()
+
+
+def pool_results(midi_paths, settings, n_workers, chunksize):
+    # process_file results in the order of midi_paths from spawned workers.
+    # a worker that dies (killed for memory, crashed in a parser) breaks the
+    # pool: the files in flight are then run again one at a time, so only the
+    # file that kills its worker is reported, and the rest go to a new pool
+    context = multiprocessing.get_context('spawn')
+    chunks = [midi_paths[i:i + chunksize] for i in range(0, len(midi_paths), chunksize)]
+    next_chunk = 0
+    in_flight = deque()
+    while next_chunk < len(chunks):
+        executor = ProcessPoolExecutor(n_workers, mp_context=context, initializer=init_worker, initargs=settings)
+        try:
+            while next_chunk < len(chunks) or in_flight:
+                while next_chunk < len(chunks) and len(in_flight) < 2 * n_workers:
+                    in_flight.append((chunks[next_chunk], executor.submit(process_files, chunks[next_chunk])))
+                    next_chunk += 1
+                results = in_flight[0][1].result()
+                in_flight.popleft()
+                yield from results
+        except BrokenProcessPool:
+            stop_executor(executor)
+            suspects, in_flight = in_flight, deque()
+            for chunk, future in suspects:
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    yield from future.result()
+                else:
+                    yield from isolated_results(chunk, settings, context)
+        except BaseException:
+            stop_executor(executor)
+            raise
+        else:
+            executor.shutdown()
+
+
+def isolated_results(paths, settings, context):
+    # one file at a time in a single worker, which is replaced when a file kills it
+    executor = None
+    try:
+        for path in paths:
+            if executor is None:
+                executor = ProcessPoolExecutor(1, mp_context=context, initializer=init_worker, initargs=settings)
+            try:
+                result = executor.submit(process_file, path).result()
+            except BrokenProcessPool:
+                stop_executor(executor)
+                executor = None
+                result = path, [], 'BrokenProcessPool: the worker process died on this file'
+            yield result
+    except BaseException:
+        if executor is not None:
+            stop_executor(executor)
+        raise
+    if executor is not None:
+        executor.shutdown()
+
+
+def prepare_data(midi_paths, tokenizer, x_len, group_size, n_workers=None, chunksize=8, report_every=10.0):
+    # segments of all files in the order of midi_paths, and a list of
+    # (path, error) for the files that failed. files are spread over
+    # n_workers processes (all cores by default, 1 runs in this process)
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = max(1, min(n_workers, len(midi_paths)))
+    segments = []
+    errors = []
+    start = time.time()
+    last_report = start
+
+    def report(done):
+        elapsed = max(time.time() - start, 1e-9)
+        print('Prepared {}/{} files, {} segments, {} errors, {:.1f} files/s'.format(
+            done, len(midi_paths), len(segments), len(errors), done / elapsed))
+
+    if n_workers == 1:
+        init_worker(tokenizer, x_len, group_size)
+        results = map(process_file, midi_paths)
+    else:
+        # spawned workers start fresh and only import this module and the
+        # caller's __main__ module, so that script should import tensorflow
+        # (model) inside its main() rather than at the top
+        results = pool_results(midi_paths, (tokenizer, x_len, group_size), n_workers, chunksize)
+    try:
+        for done, (path, new_segments, error) in enumerate(results, 1):
+            if error is not None:
+                print(f"error processing {path}, error: {error}")
+                errors.append((path, error))
+            segments.extend(new_segments)
+            if time.time() - last_report >= report_every:
+                last_report = time.time()
+                report(done)
+    finally:
+        # on an error or ctrl-c this kills the workers instead of finishing the corpus
+        if n_workers > 1:
+            results.close()
+    report(len(midi_paths))
+    return np.array(segments), errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Turn midi files into finetuning segments.')
+    parser.add_argument('midi_paths', nargs='+')
+    parser.add_argument('--dictionary', default='REMI-tempo-checkpoint/dictionary.pkl')
+    parser.add_argument('--output', required=True, help='.npy file for the segments')
+    parser.add_argument('--x-len', type=int, default=512)
+    parser.add_argument('--group-size', type=int, default=5)
+    parser.add_argument('--no-chords', action='store_true')
+    parser.add_argument('--transpose-to-key', default=None)
+    parser.add_argument('--token-cache', default=None, help='folder for cached word ids')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    event2word, _ = pickle.load(open(args.dictionary, 'rb'))
+    tokenizer = Tokenizer(
+        event2word,
+        use_chords=not args.no_chords,
+        transpose_input_midi_to_key=args.transpose_to_key,
+        token_cache=cache.TokenCache(args.token_cache) if args.token_cache else None)
+    segments, errors = prepare_data(args.midi_paths, tokenizer, args.x_len, args.group_size, n_workers=args.workers)
+    np.save(args.output, segments)
+    print(f"Saved {len(segments)} segments to {args.output}, {len(errors)} files failed")
+
+
+if __name__ == '__main__':
+    main()
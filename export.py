@@ -0,0 +1,31 @@
+from model import PopMusicTransformer
+import argparse
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export a checkpoint as a frozen inference model.')
+    parser.add_argument('--checkpoint', default='REMI-tempo-checkpoint')
+    parser.add_argument('--dictionary', default='REMI-tempo-checkpoint/dictionary.pkl')
+    parser.add_argument('--output', default='REMI-tempo-export')
+    args = parser.parse_args()
+
+    # declare model (feed_dict memory, so it can be frozen)
+    model = PopMusicTransformer(
+        checkpoint_path=args.checkpoint,
+        dictionary_path=args.dictionary,
+        is_training=False,
+        stateful_mem=False)
+
+    # export
+    model.export(args.output)
+
+    ####################################
+    # load it with
+    # PopMusicTransformer(checkpoint_path=None, dictionary_path=None, export_path=args.output)
+    ####################################
+
+    # close
+    model.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,20 @@
-from model import PopMusicTransformer
+import cache
 from glob import glob
 import os
 os.environ['CUDA_VISIBLE_DEVICES'] = '0'
 
 def main():
+    # imported here so that the prepare_data worker processes, which import
+    # this file again, do not load tensorflow
+    from model import PopMusicTransformer
+
     # declare model
     model = PopMusicTransformer(
-        checkpoint='REMI-tempo-checkpoint',
-        is_training=True)
+        checkpoint_path='REMI-tempo-checkpoint/model',
+        dictionary_path='REMI-tempo-checkpoint/dictionary.pkl',
+        is_training=True,
+        # keeps the word ids of every file, so later runs skip re-tokenizing
+        token_cache=cache.TokenCache('token-cache'))
     # prepare data
     midi_paths = glob('YOUR PERSOANL FOLDER/*.midi') # you need to revise it
     training_data = model.prepare_data(midi_paths=midi_paths)
@@ -0,0 +1,62 @@
+import numpy as np
+
+# which event classes may follow each other, in the order item2event writes
+# them: Bar, then per item a Position followed by a note, chord or tempo
+TRANSITIONS = {
+    'Bar': ['Position'],
+    'Position': ['Note Velocity', 'Chord', 'Tempo Class'],
+    'Note Velocity': ['Note On'],
+    'Note On': ['Note Duration'],
+    'Note Duration': ['Instrument'],
+    'Instrument': ['Position', 'Bar'],
+    'Chord': ['Position', 'Bar'],
+    'Tempo Class': ['Tempo Value'],
+    'Tempo Value': ['Position', 'Bar'],
+}
+
+# classes that older dictionaries do not have; if missing, they are skipped
+OPTIONAL = ['Instrument']
+
+
+def event_class(event):
+    return event.split('_')[0]
+
+
+class REMIGrammar(object):
+    def __init__(self, event2word):
+        self.n_token = len(event2word)
+        self.classes = sorted(set(event_class(e) for e in event2word))
+        self.word_class = np.zeros(self.n_token, dtype=np.int64)
+        for event, word in event2word.items():
+            self.word_class[word] = self.classes.index(event_class(event))
+        # class -> allowed next words
+        self.class_masks = np.zeros((len(self.classes), self.n_token), dtype=bool)
+        for index, name in enumerate(self.classes):
+            followers = self.followers(name)
+            if followers is None:
+                # unknown class: no constraint
+                self.class_masks[index] = True
+                continue
+            for follower in followers:
+                self.class_masks[index] |= self.word_class == self.classes.index(follower)
+        # word -> allowed next words
+        self.next_word_masks = self.class_masks[self.word_class]
+
+    def followers(self, name):
+        if name not in TRANSITIONS:
+            return None
+        followers = []
+        for follower in TRANSITIONS[name]:
+            if follower in self.classes:
+                followers.append(follower)
+            elif follower in OPTIONAL:
+                followers.extend(self.followers(follower))
+        return followers
+
+    # allowed next words after the given last words, [batch, n_token]
+    def mask(self, last_words):
+        return self.next_word_masks[np.asarray(last_words)]
+
+    # logits [batch, n_token] with grammatically invalid words removed
+    def apply(self, logits, last_words):
+        return np.where(self.mask(last_words), logits, -np.inf)
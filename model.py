@@ -5,8 +5,16 @@ import miditoolkit
 import modules
 import pickle
 import utils
+import sampling
+import grammar
+import cache
+import dataset
 import time
 import transpose
+import os
+import json
+import shutil
+import glob
 
 # run as tf1
 import tensorflow.compat.v1 as tf
@@ -36,7 +44,12 @@ class PopMusicTransformer(object):
                  group_size=5,
                  transpose_input_midi_to_key=None,
                  exchangeable_words=None,
-                 transpose_to_all_keys=False
+                 transpose_to_all_keys=False,
+                 use_kv_cache=True,
+                 stateful_mem=True,
+                 export_path=None,
+                 prompt_cache=None,
+                 token_cache=None
                  ):
         if exchangeable_words is None:
             exchangeable_words = []
@@ -44,6 +57,21 @@ class PopMusicTransformer(object):
         # Reset tensorflow default graph
         tf.reset_default_graph()
 
+        # an exported model (see export.py) brings its own dictionary and settings
+        self.export_path = export_path
+        if self.export_path is not None:
+            if is_training:
+                raise ValueError('exported models can only be used for generation')
+            with open(os.path.join(self.export_path, 'config.json')) as f:
+                self.export_config = json.load(f)
+            settings = self.export_config['settings']
+            checkpoint_path = settings['checkpoint_path']
+            dictionary_path = os.path.join(self.export_path, 'dictionary.pkl')
+            x_len, mem_len, n_layer = settings['x_len'], settings['mem_len'], settings['n_layer']
+            d_embed, d_model, d_ff = settings['d_embed'], settings['d_model'], settings['d_ff']
+            n_head, d_head = settings['n_head'], settings['d_head']
+            use_kv_cache = settings['use_kv_cache']
+
         # load dictionary
         self.dictionary_path = dictionary_path
         self.event2word, self.word2event = pickle.load(open(self.dictionary_path, 'rb'))
@@ -62,6 +90,7 @@ class PopMusicTransformer(object):
             self.d_head = d_head
         self.d_ff = d_ff
         self.n_token = len(self.event2word)
+        self.grammar = grammar.REMIGrammar(self.event2word)
         self.learning_rate = learning_rate
         # load model
         self.is_training = is_training
@@ -75,28 +104,59 @@ class PopMusicTransformer(object):
         self.transpose_input_midi_to_key = transpose_input_midi_to_key
         self.exchangeable_words = [[self.event2word[x] for x in y] for y in exchangeable_words]
         self.transpose_to_all_keys = transpose_to_all_keys
-        self.create_model()
+        # with transpose_to_all_keys, every finetune batch is shifted by one of these
+        self.transposition_steps = [-2, -1, 0, 1, 2, 3, 4, 5]
+        # keep projected keys/values as memory while decoding (inference only)
+        self.use_kv_cache = use_kv_cache and not self.is_training
+        # keep memory in session variables instead of feeding it every step
+        self.stateful_mem = stateful_mem
+        # cache.PromptCache for encoded and prefilled prompt files
+        self.prompt_cache = prompt_cache
+        # identifies the weights in prompt cache keys, so a replaced checkpoint
+        # does not reuse memories computed with the old one
+        self.weights_version = self.get_weights_version()
+        # encoding of midi files, token_cache is a cache.TokenCache for their word ids
+        self.tokenizer = dataset.Tokenizer(
+            self.event2word,
+            use_chords=self.use_chords,
+            transpose_input_midi_to_key=self.transpose_input_midi_to_key,
+            token_cache=token_cache)
+        if self.export_path is not None:
+            self.load_model()
+        else:
+            self.create_model()
 
     ########################################
     # create model
     ########################################
     def create_model(self):
         # placeholders
-        self.x = tf.compat.v1.placeholder(tf.int32, shape=[self.batch_size, None])
-        self.y = tf.compat.v1.placeholder(tf.int32, shape=[self.batch_size, None])
-        self.mems_i = [tf.compat.v1.placeholder(tf.float32, [self.mem_len, self.batch_size, self.d_model]) for _ in
-                       range(self.n_layer)]
+        # generation decodes any number of sequences at once
+        batch_size = self.batch_size if self.is_training else None
+        self.x = tf.compat.v1.placeholder(tf.int32, shape=[batch_size, None], name='x')
+        # targets (and the loss) only exist in the training graph
+        self.y = tf.compat.v1.placeholder(tf.int32, shape=[batch_size, None]) if self.is_training else None
+        self.mems_i = [tf.compat.v1.placeholder(tf.float32, shape, name='mem_in_{}'.format(i))
+                       for i, shape in enumerate(self.mem_shapes(batch_size))]
+        mem_inputs = self.create_mem_vars() if self.stateful_mem else self.mems_i
+        if self.use_kv_cache:
+            # memory as (k, v) pairs per layer, fed and fetched as a flat list
+            kv_mems = list(zip(mem_inputs[0::2], mem_inputs[1::2]))
+            mems = None
+        else:
+            kv_mems = None
+            mems = mem_inputs
         # model
-        self.global_step = tf.compat.v1.train.get_or_create_global_step()
         initializer = tf.compat.v1.initializers.random_normal(stddev=0.02, seed=None)
         proj_initializer = tf.compat.v1.initializers.random_normal(stddev=0.01, seed=None)
         with tf.compat.v1.variable_scope(tf.compat.v1.get_variable_scope()):
             xx = tf.transpose(self.x, [1, 0])
-            yy = tf.transpose(self.y, [1, 0])
+            yy = tf.transpose(self.y, [1, 0]) if self.is_training else None
             loss, self.logits, self.new_mem = modules.transformer(
                 dec_inp=xx,
                 target=yy,
-                mems=self.mems_i,
+                mems=mems,
+                kv_mems=kv_mems,
                 n_token=self.n_token,
                 n_layer=self.n_layer,
                 d_model=self.d_model,
@@ -119,13 +179,114 @@ class PopMusicTransformer(object):
                 target_perms=None,
                 head_target=None,
                 untie_r=False,
-                proj_same_dim=True)
+                proj_same_dim=True,
+                last_only=not self.is_training)
+        if self.use_kv_cache:
+            self.new_mem = [kv for pair in self.new_mem for kv in pair]
+        # named outputs, so an exported graph can be wired up again
+        self.logits = tf.identity(self.logits, name='logits')
+        self.new_mem = [tf.identity(m, name='new_mem_{}'.format(i)) for i, m in enumerate(self.new_mem)]
+        if self.stateful_mem:
+            self.create_mem_ops()
+        self.create_sampling_ops()
+        if self.is_training:
+            self.create_train_ops(loss)
+            # saver
+            self.saver = tf.compat.v1.train.Saver()
+        else:
+            # inference: restore the model weights only (no optimizer slots)
+            self.saver = tf.compat.v1.train.Saver(var_list=tf.compat.v1.trainable_variables())
+        self.create_session()
+        if self.checkpoint_path is not None:
+            self.saver.restore(self.sess, self.checkpoint_path)
+        else:
+            init_op = tf.initialize_all_variables()
+            self.sess.run(init_op)
+        self.sess.run(tf.compat.v1.local_variables_initializer())
+
+    def create_session(self):
+        config = tf.compat.v1.ConfigProto(allow_soft_placement=True)
+        config.gpu_options.allow_growth = True
+        self.sess = tf.compat.v1.Session(config=config)
+
+    ########################################
+    # exported model
+    ########################################
+    def load_model(self):
+        # import the frozen graph instead of building the model in python
+        graph_def = tf.compat.v1.GraphDef()
+        with open(os.path.join(self.export_path, 'model.pb'), 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        tensors = self.export_config['tensors']
+        input_map = {}
+        if self.stateful_mem:
+            self.mems_i = [tf.compat.v1.placeholder(tf.float32, shape) for shape in self.mem_shapes(None)]
+            input_map = dict(zip(tensors['mems'], self.create_mem_vars()))
+        names = [tensors['x'], tensors['logits']] + tensors['new_mem'] + tensors['mems']
+        elements = tf.import_graph_def(graph_def, input_map=input_map, return_elements=names, name='frozen')
+        self.x, self.logits = elements[0], elements[1]
+        self.new_mem = elements[2:2 + len(tensors['new_mem'])]
+        if self.stateful_mem:
+            self.create_mem_ops()
+        else:
+            self.mems_i = elements[2 + len(tensors['new_mem']):]
+        self.create_sampling_ops()
+        self.saver = None
+        self.create_session()
+        self.sess.run(tf.compat.v1.local_variables_initializer())
+
+    def export(self, export_path):
+        # write a frozen, inference-optimized graph with the dictionary and the
+        # settings needed to load it again through PopMusicTransformer(export_path=...)
+        if self.is_training or self.stateful_mem or self.export_path is not None:
+            raise ValueError('export needs an inference model built from a checkpoint with stateful_mem=False')
+        from tensorflow.python.tools import optimize_for_inference_lib
+        inputs = [self.x] + self.mems_i
+        outputs = [self.logits] + self.new_mem
+        output_names = [t.op.name for t in outputs]
+        graph_def = tf.compat.v1.graph_util.convert_variables_to_constants(
+            self.sess, self.sess.graph.as_graph_def(), output_names)
+        graph_def = optimize_for_inference_lib.optimize_for_inference(
+            graph_def,
+            [t.op.name for t in inputs],
+            output_names,
+            [t.dtype.as_datatype_enum for t in inputs])
+        if not os.path.exists(export_path):
+            os.makedirs(export_path)
+        with open(os.path.join(export_path, 'model.pb'), 'wb') as f:
+            f.write(graph_def.SerializeToString())
+        shutil.copyfile(self.dictionary_path, os.path.join(export_path, 'dictionary.pkl'))
+        config = {
+            'settings': {
+                'checkpoint_path': self.checkpoint_path,
+                'x_len': self.x_len,
+                'mem_len': self.mem_len,
+                'n_layer': self.n_layer,
+                'd_embed': self.d_embed,
+                'd_model': self.d_model,
+                'n_head': self.n_head,
+                'd_head': self.d_head,
+                'd_ff': self.d_ff,
+                'use_kv_cache': self.use_kv_cache},
+            'tensors': {
+                'x': self.x.name,
+                'mems': [t.name for t in self.mems_i],
+                'logits': self.logits.name,
+                'new_mem': [t.name for t in self.new_mem]}}
+        with open(os.path.join(export_path, 'config.json'), 'w') as f:
+            json.dump(config, f, indent=2)
+        print(f"Exported model to {export_path}")
+
+    ########################################
+    # train ops
+    ########################################
+    def create_train_ops(self, loss):
+        self.global_step = tf.compat.v1.train.get_or_create_global_step()
         self.avg_loss = tf.reduce_mean(loss)
         # vars
         all_vars = tf.compat.v1.trainable_variables()
         grads = tf.gradients(self.avg_loss, all_vars)
         grads_and_vars = list(zip(grads, all_vars))
-        all_trainable_vars = tf.reduce_sum([tf.reduce_prod(v.shape) for v in tf.compat.v1.trainable_variables()])
         # optimizer
         decay_lr = tf.compat.v1.train.cosine_decay(
             self.learning_rate,
@@ -134,236 +295,461 @@ class PopMusicTransformer(object):
             alpha=0.004)
         optimizer = tf.compat.v1.train.AdamOptimizer(learning_rate=decay_lr)
         self.train_op = optimizer.apply_gradients(grads_and_vars, self.global_step)
-        # saver
-        self.saver = tf.compat.v1.train.Saver()
-        config = tf.compat.v1.ConfigProto(allow_soft_placement=True)
-        config.gpu_options.allow_growth = True
-        self.sess = tf.compat.v1.Session(config=config)
-        if self.checkpoint_path is not None:
-            self.saver.restore(self.sess, self.checkpoint_path)
-        else:
-            init_op = tf.initialize_all_variables()
-            self.sess.run(init_op)
+
+    ########################################
+    # memory
+    ########################################
+    def mem_shapes(self, batch_size):
+        if self.use_kv_cache:
+            return [(self.mem_len, batch_size, self.n_head * self.d_head)] * (2 * self.n_layer)
+        return [(self.mem_len, batch_size, self.d_model)] * self.n_layer
+
+    def init_mem(self, batch_size):
+        return [np.zeros(shape, dtype=np.float32) for shape in self.mem_shapes(batch_size)]
+
+    def create_mem_vars(self):
+        # session-resident memory (local variables, so the saver ignores them)
+        self.mem_vars = []
+        mem_inputs = []
+        for i, shape in enumerate(self.mem_shapes(self.batch_size)):
+            var = tf.compat.v1.Variable(
+                tf.zeros(shape),
+                trainable=False,
+                collections=[tf.compat.v1.GraphKeys.LOCAL_VARIABLES],
+                validate_shape=False,
+                use_resource=True,
+                name='mem_{}'.format(i))
+            value = var.read_value()
+            value.set_shape((shape[0], None, shape[2]))
+            self.mem_vars.append(var)
+            mem_inputs.append(value)
+        return mem_inputs
+
+    def create_mem_ops(self):
+        # advance: write new_mem back once logits and new_mem are computed
+        with tf.control_dependencies([self.logits] + self.new_mem):
+            self.update_mem = tf.group(*[var.assign(m) for var, m in zip(self.mem_vars, self.new_mem)])
+        # reset: zero memory for a given batch size
+        self.mem_batch_size = tf.compat.v1.placeholder(tf.int32, shape=[])
+        self.reset_mem_op = tf.group(*[
+            var.assign(tf.zeros([shape[0], self.mem_batch_size, shape[2]]))
+            for var, shape in zip(self.mem_vars, self.mem_shapes(self.batch_size))])
+        # fork: gather batch entries, e.g. [0, 0, 0] copies entry 0 three times
+        self.fork_indices = tf.compat.v1.placeholder(tf.int32, shape=[None])
+        self.fork_mem_op = tf.group(*[var.assign(tf.gather(var, self.fork_indices, axis=1)) for var in self.mem_vars])
+        # load: write memory fed through self.mems_i
+        self.load_mem_op = tf.group(*[var.assign(m) for var, m in zip(self.mem_vars, self.mems_i)])
+
+    def reset_mem(self, batch_size):
+        self.sess.run(self.reset_mem_op, feed_dict={self.mem_batch_size: batch_size})
+
+    def fork_mem(self, indices):
+        self.sess.run(self.fork_mem_op, feed_dict={self.fork_indices: indices})
+
+    def get_mem(self):
+        return self.sess.run(self.mem_vars)
+
+    def set_mem(self, batch_m):
+        self.sess.run(self.load_mem_op, feed_dict=dict(zip(self.mems_i, batch_m)))
+
+    def run_step(self, fetches, feed_dict, batch_m=None):
+        # run the model for one step and advance the memory; in stateful mode
+        # the memory never leaves the session and batch_m is ignored
+        if self.stateful_mem:
+            results, _ = self.sess.run([fetches, self.update_mem], feed_dict=feed_dict)
+            return results, None
+        for m, m_np in zip(self.mems_i, batch_m):
+            feed_dict[m] = m_np
+        results, new_mem = self.sess.run([fetches, self.new_mem], feed_dict=feed_dict)
+        return results, new_mem
+
+    ########################################
+    # in-graph sampling
+    ########################################
+    def create_sampling_ops(self):
+        # temperature/top-k sampling of the last position inside the graph, so
+        # a decode step returns a few ids instead of the full logits.
+        # one temperature and topk per sequence, topk <= 0 disables top-k
+        self.last_logits = self.logits[-1]
+        self.sample_temperature = tf.compat.v1.placeholder(tf.float32, shape=[None])
+        self.sample_topk = tf.compat.v1.placeholder(tf.int32, shape=[None])
+        logits = self.last_logits / self.sample_temperature[:, None]
+        n_token = tf.shape(logits)[1]
+        # optionally keep only words the REMI grammar allows after the last input word
+        self.sample_constrained = tf.compat.v1.placeholder_with_default(False, shape=[])
+        allowed = tf.gather(tf.constant(self.grammar.next_word_masks), self.x[:, -1])
+        allowed = tf.logical_or(allowed, tf.logical_not(self.sample_constrained))
+        logits = tf.compat.v1.where(allowed, logits, tf.fill(tf.shape(logits), -np.inf))
+        topk = tf.compat.v1.where(
+            self.sample_topk > 0,
+            tf.minimum(self.sample_topk, n_token),
+            tf.fill(tf.shape(self.sample_topk), n_token))
+        values, _ = tf.math.top_k(logits, k=tf.reduce_max(topk))
+        threshold = tf.gather(values, topk - 1, batch_dims=1)
+        logits = tf.compat.v1.where(
+            logits < threshold[:, None],
+            tf.fill(tf.shape(logits), -np.inf),
+            logits)
+        self.sampled_ids = tf.cast(tf.random.categorical(logits, 1)[:, 0], tf.int32)
+        # log-probs of the sampled ids under the truncated distribution
+        self.sampled_logprobs = tf.gather(tf.nn.log_softmax(logits), self.sampled_ids, batch_dims=1)
 
     ########################################
     # temperature sampling
     ########################################
     def temperature_sampling(self, logits, temperature, topk):
-        probs = np.exp(logits / temperature) / np.sum(np.exp(logits / temperature))
-        if topk == 1:
-            prediction = np.argmax(probs)
-        else:
-            sorted_index = np.argsort(probs)[::-1]
-            candi_index = sorted_index[:topk]
-            candi_probs = [probs[i] for i in candi_index]
-            # normalize probs
-            candi_probs /= sum(candi_probs)
-            # choose by predicted probs
-            prediction = np.random.choice(candi_index, size=1, p=candi_probs)[0]
-        return prediction
+        # single sequence, see sampling.sample for batches
+        return sampling.sample(logits[None], temperature=temperature, topk=topk)[0]
 
     ########################################
     # extract events for prompt continuation
     ########################################
+    def extract_items(self, input_path, transposition_steps=0):
+        return self.tokenizer.extract_items(input_path, transposition_steps)
+
     def extract_events(self, input_path, transposition_steps=0):
-        if self.transpose_input_midi_to_key:
-            transposition_steps = transpose.get_number_of_steps_for_transposition_to(input_path,
-                                                                                     self.transpose_input_midi_to_key)
-        if transposition_steps != 0:
-            print("Transposing {} steps to {}.".format(transposition_steps, self.transpose_input_midi_to_key))
-
-        note_items, tempo_items = utils.read_items(input_path, transposition_steps=transposition_steps)
-        note_items = utils.quantize_items(note_items)
-        max_time = note_items[-1].end
-        if self.use_chords:
-            chord_items = utils.extract_chords(note_items)
-            items = chord_items + tempo_items + note_items
-        else:
-            items = tempo_items + note_items
-        groups = utils.group_items(items, max_time)
-        events = utils.item2event(groups)
-        return events
+        return self.tokenizer.extract_events(input_path, transposition_steps)
+
+    def extract_words(self, input_path, transposition_steps=0):
+        return self.tokenizer.extract_words(input_path, transposition_steps)
 
     ########################################
     # generate
     ########################################
-    def generate_batch(self, number_of_results, n_target_bar, temperature, topk, output_path, prompt=None):
-        for i in range(number_of_results):
-            self.generate(n_target_bar, temperature, topk, output_path + "/result_{}.midi".format(i), prompt)
+    def generate_batch(self, number_of_results, n_target_bar, temperature, topk, output_path, prompt=None,
+                       topp=None, minp=None, seed=None, constrained=False):
+        # prompt can be a single path (shared) or a list with one path per result
+        prompts = prompt if isinstance(prompt, (list, tuple)) else [prompt] * number_of_results
+        output_paths = [output_path + "/result_{}.midi".format(i) for i in range(number_of_results)]
+        self.generate(n_target_bar, temperature, topk, output_paths, prompts,
+                      topp=topp, minp=minp, seed=seed, constrained=constrained)
+
+    def generate(self, n_target_bar, temperature, topk, output_path, prompt=None,
+                 topp=None, minp=None, seed=None, constrained=False):
+        # a list of output paths decodes one sequence per path in a single batch
+        if isinstance(output_path, (list, tuple)):
+            output_paths = list(output_path)
+            prompts = prompt if isinstance(prompt, (list, tuple)) else [prompt] * len(output_paths)
+        else:
+            output_paths = [output_path]
+            prompts = [prompt]
 
-    def generate(self, n_target_bar, temperature, topk, output_path, prompt=None):
         # if prompt, load it. Or, random start
-        number_of_bars_in_prompt = 0
-        first_note = True
-        duration_classes = [v for k, v in self.event2word.items() if 'Note Duration' in k]
+        words, bars_in_prompts, _logits, batch_m = self.prefill_prompts(prompts)
+        original_lengths = [len(ws) for ws in words]
 
-        if prompt:
-            events = self.extract_events(prompt)
-            words = [[self.event2word['{}_{}'.format(e.name, e.value)] for e in events]]
-            words[0].append(self.event2word['Bar_None'])
-            number_of_bars_in_prompt = words[0].count(self.event2word['Bar_None']) - 1
+        # generate
+        self.decode(words, n_target_bar, temperature, topk, topp=topp, minp=minp, seed=seed, constrained=constrained,
+                    prefilled=(_logits, batch_m))
+
+        # write
+        for ws, original_length, p, path, number_of_bars_in_prompt in zip(
+                words, original_lengths, prompts, output_paths, bars_in_prompts):
+            self.write_words(ws, path, p, original_length, number_of_bars_in_prompt)
+
+    def generate_variations(self, number_of_results, n_target_bar, temperature, topk, output_path, prompt=None,
+                            topp=None, minp=None, seed=None, constrained=False):
+        # encode and prefill the prompt once, then fork number_of_results
+        # continuations from its memory. sampling settings may be one value
+        # per continuation; seed may be one seed or a list with one per result
+        (words,), (number_of_bars_in_prompt,), _logits, batch_m = self.prefill_prompts([prompt])
+        original_length = len(words)
+
+        # fork
+        branches = [0] * number_of_results
+        if self.stateful_mem:
+            self.fork_mem(branches)
         else:
-            words = []
-            for _ in range(self.batch_size):
-                ws = [self.event2word['Bar_None']]
-                if 'chord' in self.checkpoint_path:
-                    tempo_classes = [v for k, v in self.event2word.items() if 'Tempo Class' in k]
-                    tempo_values = [v for k, v in self.event2word.items() if 'Tempo Value' in k]
-                    chords = [v for k, v in self.event2word.items() if 'Chord' in k]
-                    ws.append(self.event2word['Position_1/16'])
-                    ws.append(np.random.choice(chords))
-                    ws.append(self.event2word['Position_1/16'])
-                    ws.append(np.random.choice(tempo_classes))
-                    ws.append(np.random.choice(tempo_values))
-                else:
-                    tempo_classes = [v for k, v in self.event2word.items() if 'Tempo Class' in k]
-                    tempo_values = [v for k, v in self.event2word.items() if 'Tempo Value' in k]
-                    ws.append(self.event2word['Position_1/16'])
-                    ws.append(np.random.choice(tempo_classes))
-                    ws.append(np.random.choice(tempo_values))
-                words.append(ws)
-        # initialize mem
-        batch_m = [np.zeros((self.mem_len, self.batch_size, self.d_model), dtype=np.float32) for _ in
-                   range(self.n_layer)]
+            batch_m = [m[:, branches] for m in batch_m]
+        words = [list(words) for _ in branches]
+
         # generate
-        original_length = len(words[0])
-        initial_flag = 1
-        current_generated_bar = 0
-        while current_generated_bar < n_target_bar:
-            # input
-            if initial_flag:
-                temp_x = np.zeros((self.batch_size, original_length))
-                for b in range(self.batch_size):
-                    for z, t in enumerate(words[b]):
-                        temp_x[b][z] = t
-                initial_flag = 0
-            else:
-                temp_x = np.zeros((self.batch_size, 1))
-                for b in range(self.batch_size):
-                    temp_x[b][0] = words[b][-1]
-            # prepare feed dict
-            feed_dict = {self.x: temp_x}
-            for m, m_np in zip(self.mems_i, batch_m):
-                feed_dict[m] = m_np
-            # model (prediction)
-            _logits, _new_mem = self.sess.run([self.logits, self.new_mem], feed_dict=feed_dict)
-            # sampling
-            _logit = _logits[-1, 0]
-            word = self.temperature_sampling(
-                logits=_logit,
-                temperature=temperature,
-                topk=topk)
-
-            # First note gets a completely random duration
-            if first_note and 'Note Duration' in self.word2event[word]:
-                word = np.random.choice(duration_classes)
-                first_note = False
-
-            words[0].append(word)
-            # if bar event (only work for batch_size=1)
-            if word == self.event2word['Bar_None']:
-                current_generated_bar += 1
-            # re-new mem
-            batch_m = _new_mem
+        self.decode(words, n_target_bar, temperature, topk, topp=topp, minp=minp, seed=seed,
+                    constrained=constrained, prefilled=(_logits[branches], batch_m))
+
         # write
+        for i, ws in enumerate(words):
+            self.write_words(ws, output_path + "/result_{}.midi".format(i), prompt, original_length,
+                             number_of_bars_in_prompt)
+
+    def write_words(self, words, output_path, prompt=None, original_length=0, bars_in_prompt=0):
         if prompt:
             utils.write_midi(
-                words=words[0][original_length:],
+                words=words[original_length:],
                 word2event=self.word2event,
                 output_path=output_path,
                 prompt_path=prompt,
-                bars_in_prompt=number_of_bars_in_prompt)
+                bars_in_prompt=bars_in_prompt)
         else:
             utils.write_midi(
-                words=words[0],
+                words=words,
                 word2event=self.word2event,
                 output_path=output_path,
                 prompt_path=None)
 
+    def prompt_words(self, prompt=None):
+        # words to start from and the number of bars in the prompt
+        if prompt:
+            words = self.extract_words(prompt)
+            words.append(self.event2word['Bar_None'])
+            return words, words.count(self.event2word['Bar_None']) - 1
+
+        words = [self.event2word['Bar_None']]
+        tempo_classes = [v for k, v in self.event2word.items() if 'Tempo Class' in k]
+        tempo_values = [v for k, v in self.event2word.items() if 'Tempo Value' in k]
+        if 'chord' in self.checkpoint_path:
+            chords = [v for k, v in self.event2word.items() if 'Chord' in k]
+            words.append(self.event2word['Position_1/16'])
+            words.append(np.random.choice(chords))
+        words.append(self.event2word['Position_1/16'])
+        words.append(np.random.choice(tempo_classes))
+        words.append(np.random.choice(tempo_values))
+        return words, 0
+
+    def get_weights_version(self):
+        if self.export_path is not None:
+            paths = [os.path.join(self.export_path, 'model.pb')]
+        elif self.checkpoint_path is not None:
+            # the .index and .data-* files of the checkpoint
+            paths = glob.glob(glob.escape(self.checkpoint_path) + '.*')
+        else:
+            paths = []
+        if not paths:
+            # randomly initialized weights are never shared
+            return os.urandom(16).hex()
+        return cache.files_version(paths)
+
+    def prompt_cache_key(self, prompt):
+        # everything the encoded words and the prefilled memory depend on
+        return cache.make_key(
+            cache.file_hash(prompt), self.checkpoint_path, self.weights_version, self.use_chords, self.transpose_input_midi_to_key,
+            self.tokenizer.dictionary_version, utils.encoding_params(), self.x_len, self.mem_len, self.use_kv_cache)
+
+    def encode_prompt(self, prompt):
+        # (words, bars in prompt, cache key, cached entry) for a prompt path or
+        # None; key and entry are None unless the prompt cache is in use
+        key, entry = None, None
+        if prompt and self.prompt_cache is not None:
+            key = self.prompt_cache_key(prompt)
+            entry = self.prompt_cache.get(key)
+        if entry is not None:
+            return entry['words'].tolist(), int(entry['bars_in_prompt']), key, entry
+        words, number_of_bars_in_prompt = self.prompt_words(prompt)
+        return words, number_of_bars_in_prompt, key, None
+
+    def prefill_prompts(self, prompts):
+        # prompt_words and prefill for a batch of prompts (paths or None),
+        # returns (words, bars in prompt, last logits, memory)
+        encoded = [self.encode_prompt(p) for p in prompts]
+        _logits, batch_m = self.prefill_encoded(encoded)
+        return [e[0] for e in encoded], [e[1] for e in encoded], _logits, batch_m
+
+    def prefill_encoded(self, encoded):
+        # prefill for encode_prompt results: cached prompts take their logits
+        # and memory from the cache, the others are prefilled and, if they
+        # have a cache key, stored
+        words = [e[0] for e in encoded]
+        hits = [b for b, e in enumerate(encoded) if e[3] is not None]
+        misses = [b for b, e in enumerate(encoded) if e[3] is None]
+        # nothing cached and nothing to cache
+        if not hits and all(encoded[b][2] is None for b in misses):
+            return self.prefill(words)
+
+        logits = np.zeros((len(encoded), self.n_token), dtype=np.float32)
+        batch_m = self.init_mem(len(encoded))
+        if misses:
+            _logits, miss_m = self.prefill([words[b] for b in misses])
+            if self.stateful_mem:
+                miss_m = self.get_mem()
+            logits[misses] = _logits
+            for m, new_m in zip(batch_m, miss_m):
+                m[:, misses] = new_m
+            for row, b in enumerate(misses):
+                if encoded[b][2] is None:
+                    continue
+                entry = {
+                    'words': np.array(words[b], dtype=np.int32),
+                    'bars_in_prompt': np.array(encoded[b][1]),
+                    'logits': _logits[row].copy()}
+                for i, new_m in enumerate(miss_m):
+                    entry['mem_{}'.format(i)] = new_m[:, row].copy()
+                self.prompt_cache.put(encoded[b][2], entry)
+        for b in hits:
+            logits[b] = encoded[b][3]['logits']
+            for i, m in enumerate(batch_m):
+                m[:, b] = encoded[b][3]['mem_{}'.format(i)]
+        if self.stateful_mem:
+            self.set_mem(batch_m)
+            batch_m = None
+        return logits, batch_m
+
+    def prefill(self, words):
+        # run the prompts through the model and return the last logits of each
+        # sequence plus the memory of the whole batch (None when stateful).
+        # prompts of equal length share one run, so lengths may differ.
+        # long prompts are fed x_len words at a time with the memory carried
+        # over, which bounds attention cost and activation memory per run.
+        groups = {}
+        for b, ws in enumerate(words):
+            groups.setdefault(len(ws), []).append(b)
+        order = []
+        all_logits = []
+        all_mems = []
+        for indices in groups.values():
+            batch_m = None
+            if self.stateful_mem:
+                self.reset_mem(len(indices))
+            else:
+                batch_m = self.init_mem(len(indices))
+            temp_x = np.array([words[b] for b in indices])
+            for start in range(0, temp_x.shape[1], self.x_len):
+                _logits, batch_m = self.run_step(
+                    self.last_logits, {self.x: temp_x[:, start:start + self.x_len]}, batch_m)
+            if self.stateful_mem and len(groups) > 1:
+                batch_m = self.get_mem()
+            order.extend(indices)
+            all_logits.append(_logits)
+            all_mems.append(batch_m)
+        if len(groups) == 1:
+            return all_logits[0], all_mems[0]
+        # merge the groups back into input order
+        inverse = np.argsort(order)
+        logits = np.concatenate(all_logits)[inverse]
+        batch_m = [np.concatenate(m, axis=1)[:, inverse] for m in zip(*all_mems)]
+        if self.stateful_mem:
+            self.set_mem(batch_m)
+            batch_m = None
+        return logits, batch_m
+
+    def decode(self, words, n_target_bar, temperature, topk, topp=None, minp=None, seed=None, constrained=False,
+               prefilled=None):
+        for _ in self.decode_stream(words, n_target_bar, temperature, topk, topp=topp, minp=minp, seed=seed,
+                                    constrained=constrained, prefilled=prefilled):
+            pass
+        return words
+
+    def decode_stream(self, words, n_target_bar, temperature, topk, topp=None, minp=None, seed=None,
+                      constrained=False, prefilled=None):
+        # extend every list in words until it has n_target_bar new bars and
+        # yield (sequence index, word) as soon as a word is sampled;
+        # finished sequences are dropped from the batch. the memory lives in
+        # the session, so finish (or drop) one stream before starting another.
+        # sampling settings may be scalars or one value per sequence; a seed
+        # gives every sequence its own reproducible random stream.
+        # temperature/top-k alone are sampled in-graph after the first token,
+        # top-p, min-p and seeds need the logits on the host.
+        # constrained only samples words the REMI grammar allows next.
+        # prefilled: (last logits, memory) from an earlier prefill of words
+        bar_word = self.event2word['Bar_None']
+        duration_classes = [v for k, v in self.event2word.items() if 'Note Duration' in k]
+        first_note = [True] * len(words)
+        current_generated_bar = [0] * len(words)
+
+        rngs = sampling.create_rngs(len(words), seed)
+        in_graph = topp is None and minp is None and seed is None
+        temperatures = sampling.per_sequence(temperature, len(words))
+        topks = sampling.per_sequence(0 if topk is None else topk, len(words), dtype=np.int64)
+        topps = None if topp is None else sampling.per_sequence(topp, len(words))
+        minps = None if minp is None else sampling.per_sequence(minp, len(words))
+
+        def sample(_logits):
+            if constrained:
+                _logits = self.grammar.apply(_logits, [words[b][-1] for b in active])
+            return sampling.sample(
+                _logits,
+                temperature=temperatures[active],
+                topk=topks[active],
+                topp=None if topps is None else topps[active],
+                minp=None if minps is None else minps[active],
+                rngs=[rngs[b] for b in active] if rngs else None)
+
+        _logits, batch_m = self.prefill(words) if prefilled is None else prefilled
+        active = list(range(len(words)))
+        sampled = sample(_logits)
+        while True:
+            for row, b in enumerate(active):
+                word = sampled[row]
+
+                # First note gets a completely random duration
+                if first_note[b] and 'Note Duration' in self.word2event[word]:
+                    word = rngs[b].choice(duration_classes) if rngs else np.random.choice(duration_classes)
+                    first_note[b] = False
+
+                words[b].append(word)
+                # if bar event
+                if word == bar_word:
+                    current_generated_bar[b] += 1
+                yield b, word
+            # stop finished sequences
+            keep = [row for row, b in enumerate(active) if current_generated_bar[b] < n_target_bar]
+            if len(keep) == 0:
+                break
+            if len(keep) < len(active):
+                active = [active[row] for row in keep]
+                if self.stateful_mem:
+                    self.fork_mem(keep)
+                else:
+                    batch_m = [m[:, keep] for m in batch_m]
+            # model (prediction) and sampling
+            temp_x = np.array([[words[b][-1]] for b in active])
+            if in_graph:
+                feed_dict = {
+                    self.x: temp_x,
+                    self.sample_temperature: temperatures[active],
+                    self.sample_topk: topks[active],
+                    self.sample_constrained: constrained}
+                sampled, batch_m = self.run_step(self.sampled_ids, feed_dict, batch_m)
+            else:
+                _logits, batch_m = self.run_step(self.last_logits, {self.x: temp_x}, batch_m)
+                sampled = sample(_logits)
+
+    def generate_stream(self, n_target_bar, temperature, topk, prompt=None, output_path=None,
+                        topp=None, minp=None, seed=None, constrained=False):
+        # yield every generated bar as soon as its closing Bar event is sampled,
+        # as an array of notes (start, end, pitch, velocity, instrument).
+        # the midi file is written at the end when output_path is given
+        (words,), (number_of_bars_in_prompt,), _logits, batch_m = self.prefill_prompts([prompt])
+        writer = utils.MidiWriter(self.word2event, prompt_path=prompt, bars_in_prompt=number_of_bars_in_prompt)
+        bar_word = self.event2word['Bar_None']
+        # without prompt, the start words (tempo, chord) belong to the first bar
+        bar = [] if prompt else words[1:]
+        for _, word in self.decode_stream([words], n_target_bar, temperature, topk, topp=topp, minp=minp, seed=seed,
+                                          constrained=constrained, prefilled=(_logits, batch_m)):
+            if word == bar_word:
+                yield writer.add_bar(bar)
+                bar = []
+            else:
+                bar.append(word)
+        if output_path:
+            writer.write(output_path)
+
     ########################################
     # prepare training data
     ########################################
-    def prepare_data(self, midi_paths):
-        # extract events
-        segments = []
-
-        transposition_steps = [0]
-        if self.transpose_to_all_keys:
-            transposition_steps = [-2, -1, 0, 1, 2, 3, 4, 5]
-
-        for path in midi_paths:
-            for transposition_step in transposition_steps:
-                try:
-                    all_events = []
-
-                    print(f"Extracting events for {path}")
-                    events = self.extract_events(path, transposition_step)
-                    all_events.append(events)
-
-                    # event to word
-                    all_words = []
-                    for events in all_events:
-                        words = []
-                        for event in events:
-                            e = '{}_{}'.format(event.name, event.value)
-                            if e in self.event2word:
-                                words.append(self.event2word[e])
-                            else:
-                                # OOV
-                                if event.name == 'Note Velocity':
-                                    # replace with max velocity based on our training data
-                                    words.append(self.event2word['Note Velocity_21'])
-                                else:
-                                    # something is wrong
-                                    # you should handle it for your own purpose
-                                    print('something is wrong! {}'.format(e))
-                        all_words.append(words)
-
-                    # to training data
-                    new_segments = []
-                    for words in all_words:
-                        pairs = []
-                        for i in range(0, len(words) - self.x_len - 1, self.x_len):
-                            x = words[i:i + self.x_len]
-                            y = words[i + 1:i + self.x_len + 1]
-                            pairs.append([x, y])
-                        pairs = np.array(pairs)
-                        # abandon the last
-                        for i in np.arange(0, len(pairs) - self.group_size, self.group_size * 2):
-                            data = pairs[i:i + self.group_size]
-                            if len(data) == self.group_size:
-                                new_segments.append(data)
-
-                    # Create reverse segments
-                    for words in all_words:
-                        pairs = []
-                        for i in range(len(words) - 1, self.x_len, -self.x_len):
-                            x = words[i - self.x_len - 1:i - 1]
-                            y = words[i - self.x_len:i]
-                            pairs.append([x, y])
-                        pairs = np.array(pairs[::-1])
-                        # abandon the last
-                        for i in np.arange(0, len(pairs) - self.group_size, self.group_size * 2):
-                            data = pairs[i:i + self.group_size]
-                            if len(data) == self.group_size:
-                                new_segments.append(data)
-
-                    print(f"Prepared {len(new_segments)} segments.")
-                    segments.extend(new_segments)
-                except Exception as e:
-                    print(f"error processing {path}, error: {e}")
-        segments = np.array(segments)
+    def prepare_data(self, midi_paths, n_workers=1):
+        # extract events in n_workers processes (see dataset.prepare_data);
+        # with transpose_to_all_keys the segments are transposed per batch in
+        # finetune, so one copy is enough.
+        # n_workers > 1 spawns workers that import the calling script again:
+        # it needs an if __name__ == '__main__' guard and should import model
+        # inside main(), or every worker loads tensorflow. for large corpora
+        # use dataset.py, which never imports tensorflow
+        segments, _ = dataset.prepare_data(
+            midi_paths, self.tokenizer, self.x_len, self.group_size, n_workers=n_workers)
         return segments
 
     ########################################
     # finetune
     ########################################
     def finetune(self, training_data, output_checkpoint_folder, epochs=200, stop_loss=None, save_checkpoint_batch=100):
+        if not self.is_training:
+            raise ValueError('finetune needs a model created with is_training=True')
         # shuffle
         index = np.arange(len(training_data))
         np.random.shuffle(index)
         training_data = training_data[index]
         num_batches = len(training_data) // self.batch_size
+        transposition_tables = self.create_transposition_tables() if self.transpose_to_all_keys else None
         print('num_batches:', num_batches)
         print('training_data.shape:', training_data.shape)
         st = time.time()
@@ -372,8 +758,16 @@ class PopMusicTransformer(object):
             for i in range(num_batches):
                 segments = training_data[self.batch_size * i:self.batch_size * (i + 1)]
 
-                batch_m = [np.zeros((self.mem_len, self.batch_size, self.d_model), dtype=np.float32) for _ in
-                           range(self.n_layer)]
+                # Transpose the whole batch by one random step
+                if transposition_tables is not None:
+                    step = np.random.choice(self.transposition_steps)
+                    segments = self.transpose_segments(segments, transposition_tables[step])
+
+                batch_m = None
+                if self.stateful_mem:
+                    self.reset_mem(self.batch_size)
+                else:
+                    batch_m = self.init_mem(self.batch_size)
 
                 for j in range(self.group_size):
                     try:
@@ -386,12 +780,9 @@ class PopMusicTransformer(object):
 
                         # prepare feed dict
                         feed_dict = {self.x: batch_x, self.y: batch_y}
-                        for m, m_np in zip(self.mems_i, batch_m):
-                            feed_dict[m] = m_np
                         # run
-                        _, gs_, loss_, new_mem_ = self.sess.run(
-                            [self.train_op, self.global_step, self.avg_loss, self.new_mem], feed_dict=feed_dict)
-                        batch_m = new_mem_
+                        (_, gs_, loss_), batch_m = self.run_step(
+                            [self.train_op, self.global_step, self.avg_loss], feed_dict, batch_m)
                         total_loss.append(loss_)
                         print('>>> Epoch: {}, Step: {}, Loss: {:.5f}, Time: {:.2f}'.format(e, gs_, loss_,
                                                                                            time.time() - st))
@@ -418,6 +809,36 @@ class PopMusicTransformer(object):
                 if batch_y[i][j] in exchangeable_words_mapping:
                     batch_y[i][j] = exchangeable_words_mapping[batch_y[i][j]]
 
+    def create_transposition_tables(self):
+        # step -> word remap table shifting Note On pitches (wrapped by an
+        # octave like utils.transpose_items) and chord roots
+        words = np.arange(self.n_token)
+        tables = {}
+        for step in self.transposition_steps:
+            table = words.copy()
+            for event, word in self.event2word.items():
+                name, value = event.split('_')
+                if name == 'Note On':
+                    pitch = int(value) + step
+                    if pitch < 0:
+                        pitch += 12
+                    if pitch > 127:
+                        pitch -= 12
+                    # stay inside the pitch range of the dictionary
+                    for candidate in [pitch, pitch - 12, pitch + 12]:
+                        if 'Note On_{}'.format(candidate) in self.event2word:
+                            table[word] = self.event2word['Note On_{}'.format(candidate)]
+                            break
+                elif name == 'Chord' and value.split(':')[0] in transpose.PITCH_CLASSES:
+                    root, quality = value.split(':')
+                    root = transpose.PITCH_CLASSES[(transpose.PITCH_CLASSES.index(root) + step) % 12]
+                    table[word] = self.event2word.get('Chord_{}:{}'.format(root, quality), word)
+            tables[step] = table
+        return tables
+
+    def transpose_segments(self, segments, table):
+        return dataset.transpose_segments(segments, table, self.event2word)
+
     def create_exchangeable_words_mapping(self):
         mapping = {}
 
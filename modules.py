@@ -32,7 +32,10 @@ def normal_softmax(hidden, target, n_token, params, scope='normal_softmax', **kw
     with tf.compat.v1.variable_scope(scope):
         softmax_b = tf.compat.v1.get_variable('bias', [n_token], initializer=tf.zeros_initializer())
         output = _logit(hidden, params_W, softmax_b, params_projs)
-        nll = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=target, logits=output)
+        if target is None:
+            nll = None
+        else:
+            nll = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=target, logits=output)
     return nll, output
 
 
@@ -92,14 +95,23 @@ def rel_shift(x):
 
 def rel_multihead_attn(w, r, r_w_bias, r_r_bias, attn_mask, mems, d_model,
                        n_head, d_head, dropout, dropatt, is_training,
-                       kernel_initializer, scope='rel_attn'):
+                       kernel_initializer, scope='rel_attn', kv_mems=None):
+    """
+    kv_mems: an optional (k, v) pair of already projected memory keys and
+        values, each of size [mlen, bsz, n_head * d_head]. When given, only
+        `w` is projected and `mems` is ignored (incremental decoding).
+    Returns the attention output and the (k, v) projections of `w`.
+    """
     scale = 1 / (d_head ** 0.5)
     with tf.compat.v1.variable_scope(scope):
         qlen = tf.shape(w)[0]
         rlen = tf.shape(r)[0]
         bsz = tf.shape(w)[1]
 
-        cat = tf.concat([mems, w], 0) if mems is not None and mems.shape.ndims > 1 else w
+        if kv_mems is not None:
+            cat = w
+        else:
+            cat = tf.concat([mems, w], 0) if mems is not None and mems.shape.ndims > 1 else w
 
         w_heads = tf.keras.layers.Dense(3 * n_head * d_head, use_bias=False, 
                                         kernel_initializer=kernel_initializer, name='qkv')(cat)
@@ -108,6 +120,10 @@ def rel_multihead_attn(w, r, r_w_bias, r_r_bias, attn_mask, mems, d_model,
         
         w_head_q, w_head_k, w_head_v = tf.split(w_heads, 3, -1)
         w_head_q = w_head_q[-qlen:]
+        new_kv = (w_head_k[-qlen:], w_head_v[-qlen:])
+        if kv_mems is not None:
+            w_head_k = tf.concat([kv_mems[0], w_head_k], 0)
+            w_head_v = tf.concat([kv_mems[1], w_head_v], 0)
 
         klen = tf.shape(w_head_k)[0]
 
@@ -139,7 +155,7 @@ def rel_multihead_attn(w, r, r_w_bias, r_r_bias, attn_mask, mems, d_model,
                                          kernel_initializer=kernel_initializer, name='o')(attn_vec)
         attn_out = tf.keras.layers.Dropout(dropout)(attn_out, training=is_training)
         output = tf.keras.layers.LayerNormalization(axis=-1)(attn_out + w)
-        return output
+        return output, new_kv
 
 
 def transformer(dec_inp, target, mems, n_token, n_layer, d_model, d_embed,
@@ -149,12 +165,19 @@ def transformer(dec_inp, target, mems, n_token, n_layer, d_model, d_embed,
                 same_length=False, clamp_len=-1,
                 input_perms=None, target_perms=None, head_target=None,
                 untie_r=False, proj_same_dim=True,
-                scope='transformer'):
+                scope='transformer', kv_mems=None, last_only=False):
     """
     cutoffs: a list of python int. Cutoffs for adaptive softmax.
     tie_projs: a list of python bools. Whether to tie the projections.
     perms: a list of tensors. Each tensor should of size [len, bsz, bin_size].
         Only used in the adaptive setting.
+    target: may be None for inference, in which case the returned loss is None.
+    kv_mems: a list of (k, v) pairs, one per layer, holding the projected
+        keys and values of the memory. When given, `mems` is ignored and the
+        returned new mems are the updated (k, v) caches instead of hidden
+        states, so each step only projects the new tokens.
+    last_only: project only the last position onto the vocabulary (logits of
+        size [1, bsz, n_token]), for generation.
     """
     new_mems = []
     with tf.compat.v1.variable_scope(scope):
@@ -166,7 +189,11 @@ def transformer(dec_inp, target, mems, n_token, n_layer, d_model, d_embed,
             r_r_bias = tf.compat.v1.get_variable('r_r_bias', [n_head, d_head], initializer=initializer)
 
         qlen = tf.shape(dec_inp)[0]
-        mlen = tf.shape(mems[0])[0] if mems is not None else 0
+        if kv_mems is not None:
+            mems = None
+            mlen = tf.shape(kv_mems[0][0])[0]
+        else:
+            mlen = tf.shape(mems[0])[0] if mems is not None else 0
         klen = qlen + mlen
 
         if proj_initializer is None:
@@ -193,13 +220,16 @@ def transformer(dec_inp, target, mems, n_token, n_layer, d_model, d_embed,
 
         if mems is None:
             mems = [None] * n_layer
+        if kv_mems is None:
+            kv_mems = [None] * n_layer
 
         for i in range(n_layer):
             # cache new mems
-            new_mems.append(_cache_mem(output, mems[i], mem_len))
+            if kv_mems[i] is None:
+                new_mems.append(_cache_mem(output, mems[i], mem_len))
 
             with tf.compat.v1.variable_scope('layer_{}'.format(i)):
-                output = rel_multihead_attn(
+                output, new_kv = rel_multihead_attn(
                     w=output,
                     r=pos_emb,
                     r_w_bias=r_w_bias if not untie_r else r_w_bias[i],
@@ -212,7 +242,11 @@ def transformer(dec_inp, target, mems, n_token, n_layer, d_model, d_embed,
                     dropout=dropout,
                     dropatt=dropatt,
                     is_training=is_training,
-                    kernel_initializer=initializer)
+                    kernel_initializer=initializer,
+                    kv_mems=kv_mems[i])
+
+                if kv_mems[i] is not None:
+                    new_mems.append(tuple(_cache_mem(kv, mem, mem_len) for kv, mem in zip(new_kv, kv_mems[i])))
 
                 output = positionwise_FF(
                     inp=output,
@@ -223,6 +257,8 @@ def transformer(dec_inp, target, mems, n_token, n_layer, d_model, d_embed,
                     is_training=is_training)
 
         output = tf.keras.layers.Dropout(dropout)(output, training=is_training)
+        if last_only:
+            output = output[-1:]
 
         loss, logits = normal_softmax(
             hidden=output,
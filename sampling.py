@@ -0,0 +1,85 @@
+import numpy as np
+
+
+# one independent random stream per sequence, so a batch run is reproducible
+# no matter how many sequences it decodes or when they finish.
+# seed is either one seed for the batch or a list with one seed per sequence
+def create_rngs(number_of_sequences, seed=None):
+    if seed is None:
+        return None
+    if isinstance(seed, (list, tuple, np.ndarray)):
+        return [np.random.default_rng(s) for s in seed]
+    return [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(number_of_sequences)]
+
+
+# broadcast a sampling setting (scalar or one value per sequence) to [batch]
+def per_sequence(value, batch_size, dtype=np.float64):
+    return np.broadcast_to(np.asarray(value, dtype=dtype), (batch_size,))
+
+
+# numerically stable softmax over the last axis, logits: [batch, vocab]
+def softmax(logits, temperature=1.0):
+    logits = np.asarray(logits, dtype=np.float64)
+    temperature = per_sequence(temperature, len(logits))[:, None]
+    scaled = logits / temperature
+    scaled -= np.max(scaled, axis=-1, keepdims=True)
+    probs = np.exp(scaled)
+    return probs / np.sum(probs, axis=-1, keepdims=True)
+
+
+def topk_mask(probs, topk):
+    topk = per_sequence(topk, len(probs), dtype=np.int64)
+    mask = np.zeros(probs.shape, dtype=bool)
+    # argpartition once per distinct k (usually there is only one)
+    for k in np.unique(topk):
+        rows = np.where(topk == k)[0]
+        if k <= 0 or k >= probs.shape[-1]:
+            mask[rows] = True
+            continue
+        index = np.argpartition(-probs[rows], k - 1, axis=-1)[:, :k]
+        mask[rows[:, None], index] = True
+    return mask
+
+
+def topp_mask(probs, topp):
+    topp = per_sequence(topp, len(probs))[:, None]
+    order = np.argsort(-probs, axis=-1)
+    sorted_probs = np.take_along_axis(probs, order, axis=-1)
+    sorted_probs = sorted_probs / np.sum(sorted_probs, axis=-1, keepdims=True)
+    # keep tokens until the probability mass before them reaches topp
+    keep = (np.cumsum(sorted_probs, axis=-1) - sorted_probs) < topp
+    mask = np.zeros(probs.shape, dtype=bool)
+    np.put_along_axis(mask, order, keep, axis=-1)
+    return mask
+
+
+def minp_mask(probs, minp):
+    minp = per_sequence(minp, len(probs))[:, None]
+    return probs >= minp * np.max(probs, axis=-1, keepdims=True)
+
+
+# sample one token per sequence from logits [batch, vocab]
+# topk=1 is greedy; topk/topp/minp of None disable the filter
+def sample(logits, temperature=1.0, topk=None, topp=None, minp=None, rngs=None):
+    logits = np.atleast_2d(logits)
+    batch_size = len(logits)
+    probs = softmax(logits, temperature)
+    keep = np.ones(probs.shape, dtype=bool)
+    if topk is not None:
+        keep &= topk_mask(probs, topk)
+    if minp is not None:
+        keep &= minp_mask(probs, minp)
+    if topp is not None:
+        keep &= topp_mask(np.where(keep, probs, 0), topp)
+    probs = np.where(keep, probs, 0)
+    # inverse cdf, u in (0, 1] never lands on a removed token
+    if rngs is None:
+        u = 1 - np.random.random(batch_size)
+    else:
+        u = np.array([1 - rng.random() for rng in rngs])
+    cdf = np.cumsum(probs, axis=-1)
+    prediction = np.sum(cdf < u[:, None] * cdf[:, -1:], axis=-1)
+    if topk is not None:
+        greedy = per_sequence(topk, batch_size, dtype=np.int64) == 1
+        prediction[greedy] = np.argmax(logits[greedy], axis=-1)
+    return prediction
@@ -0,0 +1,309 @@
+from model import PopMusicTransformer
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import argparse
+import base64
+import json
+import os
+import queue
+import tempfile
+import threading
+import numpy as np
+import cache
+import sampling
+import utils
+
+
+# one generation request and, once finished, its result
+class Request(object):
+    def __init__(self, n_target_bar, temperature, topk, prompt=None):
+        self.n_target_bar = n_target_bar
+        self.temperature = temperature
+        self.topk = topk
+        self.prompt = prompt
+        self.words = None
+        self.original_length = 0
+        self.bars_in_prompt = 0
+        self.current_generated_bar = 0
+        self.first_note = True
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class GenerationScheduler(object):
+    ########################################
+    # initialize
+    ########################################
+    def __init__(self, model, max_batch_size=8, max_pending=32, max_bars=64, request_timeout=600.0):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_bars = max_bars
+        # seconds a client waits for its result before it gets a 504
+        self.request_timeout = request_timeout
+        # admission control: submit fails when this many requests are waiting
+        self.pending = queue.Queue(maxsize=max_pending)
+        # requests in the decode batch, in memory (batch) order
+        self.running = []
+        self.batch_m = None
+        self.bar_word = model.event2word['Bar_None']
+        self.duration_classes = [v for k, v in model.event2word.items() if 'Note Duration' in k]
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    ########################################
+    # requests
+    ########################################
+    def submit(self, params):
+        # raises ValueError for bad parameters and queue.Full when busy
+        if not isinstance(params, dict):
+            raise ValueError('request body must be a json object')
+        try:
+            request = Request(
+                n_target_bar=int(params.get('n_target_bar', 16)),
+                temperature=float(params.get('temperature', 1.2)),
+                topk=int(params.get('topk', 5)),
+                prompt=params.get('prompt'))
+        except (TypeError, ValueError) as err:
+            raise ValueError('bad parameter: {}'.format(err))
+        if request.prompt is not None and not isinstance(request.prompt, str):
+            raise ValueError('prompt must be a path')
+        if not 0 < request.n_target_bar <= self.max_bars:
+            raise ValueError('n_target_bar must be between 1 and {}'.format(self.max_bars))
+        if request.temperature <= 0:
+            raise ValueError('temperature must be positive')
+        if request.prompt and not os.path.exists(request.prompt):
+            raise ValueError('prompt {} does not exist'.format(request.prompt))
+        self.pending.put_nowait(request)
+        return request
+
+    def finish(self, request):
+        try:
+            with tempfile.TemporaryDirectory() as folder:
+                path = os.path.join(folder, 'result.midi')
+                utils.write_midi(
+                    words=request.words[request.original_length:] if request.prompt else request.words,
+                    word2event=self.model.word2event,
+                    output_path=path,
+                    prompt_path=request.prompt,
+                    bars_in_prompt=request.bars_in_prompt)
+                with open(path, 'rb') as f:
+                    midi = f.read()
+            request.result = {
+                'words': [int(w) for w in request.words],
+                'midi': base64.b64encode(midi).decode('ascii')}
+        except Exception as err:
+            request.error = str(err)
+        request.done.set()
+
+    def fail(self, requests, err):
+        for request in requests:
+            request.error = str(err)
+            request.done.set()
+
+    ########################################
+    # scheduling
+    ########################################
+    def run(self):
+        # one decode step for the whole batch per iteration; new requests
+        # join the batch between steps
+        while not self.stopped.is_set():
+            try:
+                if self.running:
+                    self.step()
+                self.admit(block=not self.running)
+            except Exception as err:
+                # fail the whole batch rather than leaving clients waiting
+                print(f"error in decode batch: {err}")
+                self.fail(self.running, err)
+                self.running = []
+                self.batch_m = None
+
+    def admit(self, block):
+        new = []
+        try:
+            if block:
+                new.append(self.pending.get(timeout=0.1))
+            while len(self.running) + len(new) < self.max_batch_size:
+                new.append(self.pending.get_nowait())
+        except queue.Empty:
+            pass
+        if not new:
+            return
+        admitted = []
+        encoded = []
+        for request in new:
+            try:
+                encoded.append(self.model.encode_prompt(request.prompt))
+                request.words, request.bars_in_prompt = list(encoded[-1][0]), encoded[-1][1]
+                request.original_length = len(request.words)
+                admitted.append(request)
+            except Exception as err:
+                self.fail([request], err)
+        if not admitted:
+            return
+        # keep the running memory, prefill the newcomers and append them
+        current_m = None
+        if self.running:
+            current_m = self.model.get_mem() if self.model.stateful_mem else self.batch_m
+        try:
+            _logits, batch_m = self.model.prefill_encoded(encoded)
+            if current_m is not None:
+                if self.model.stateful_mem:
+                    batch_m = self.model.get_mem()
+                batch_m = [np.concatenate([c, n], axis=1) for c, n in zip(current_m, batch_m)]
+                if self.model.stateful_mem:
+                    self.model.set_mem(batch_m)
+                    batch_m = None
+        except Exception as err:
+            # only the newcomers fail, the running batch keeps its memory
+            print(f"error prefilling new requests: {err}")
+            self.fail(admitted, err)
+            if current_m is not None and self.model.stateful_mem:
+                self.model.set_mem(current_m)
+            return
+        self.batch_m = batch_m
+        self.running.extend(admitted)
+        # first word of each newcomer from its prefill logits
+        sampled = sampling.sample(
+            _logits,
+            temperature=[request.temperature for request in admitted],
+            topk=[request.topk for request in admitted])
+        self.accept(admitted, sampled)
+        self.retire()
+
+    def step(self):
+        feed_dict = {
+            self.model.x: np.array([[request.words[-1]] for request in self.running]),
+            self.model.sample_temperature: [request.temperature for request in self.running],
+            self.model.sample_topk: [request.topk for request in self.running]}
+        sampled, self.batch_m = self.model.run_step(self.model.sampled_ids, feed_dict, self.batch_m)
+        self.accept(self.running, sampled)
+        self.retire()
+
+    def accept(self, requests, sampled):
+        for request, word in zip(requests, sampled):
+            # First note gets a completely random duration
+            if request.first_note and 'Note Duration' in self.model.word2event[word]:
+                word = np.random.choice(self.duration_classes)
+                request.first_note = False
+            request.words.append(word)
+            if word == self.bar_word:
+                request.current_generated_bar += 1
+
+    def retire(self):
+        # drop finished requests from the batch
+        keep = [row for row, request in enumerate(self.running)
+                if request.current_generated_bar < request.n_target_bar]
+        if len(keep) == len(self.running):
+            return
+        for request in self.running:
+            if request.current_generated_bar >= request.n_target_bar:
+                self.finish(request)
+        self.running = [self.running[row] for row in keep]
+        if not keep:
+            self.batch_m = None
+        elif self.model.stateful_mem:
+            self.model.fork_mem(keep)
+        else:
+            self.batch_m = [m[:, keep] for m in self.batch_m]
+
+
+########################################
+# http
+########################################
+class RequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != '/generate':
+            self.reply(404, {'error': 'unknown path {}'.format(self.path)})
+            return
+        try:
+            params = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            request = self.server.scheduler.submit(params)
+        except queue.Full:
+            self.reply(503, {'error': 'too many pending requests'})
+            return
+        except ValueError as err:
+            self.reply(400, {'error': str(err)})
+            return
+        if not request.done.wait(self.server.scheduler.request_timeout):
+            self.reply(504, {'error': 'generation timed out'})
+            return
+        if request.error is not None:
+            self.reply(500, {'error': request.error})
+        else:
+            self.reply(200, request.result)
+
+    def reply(self, status, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class GenerationServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, scheduler):
+        HTTPServer.__init__(self, address, RequestHandler)
+        self.scheduler = scheduler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve generation requests on localhost.')
+    parser.add_argument('--checkpoint', default='REMI-tempo-checkpoint')
+    parser.add_argument('--dictionary', default='REMI-tempo-checkpoint/dictionary.pkl')
+    parser.add_argument('--export', default=None, help='exported model folder (see export.py)')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch-size', type=int, default=8)
+    parser.add_argument('--max-pending', type=int, default=32)
+    parser.add_argument('--request-timeout', type=float, default=600.0, help='seconds before a client gets a 504')
+    parser.add_argument('--prompt-cache-mb', type=int, default=0, help='RAM for cached prompts, 0 disables')
+    parser.add_argument('--prompt-cache-dir', default=None, help='spill evicted prompts to this folder')
+    parser.add_argument('--prompt-cache-disk-mb', type=int, default=8192)
+    args = parser.parse_args()
+
+    prompt_cache = None
+    if args.prompt_cache_mb > 0:
+        prompt_cache = cache.PromptCache(
+            max_bytes=args.prompt_cache_mb << 20,
+            cache_dir=args.prompt_cache_dir,
+            max_disk_bytes=args.prompt_cache_disk_mb << 20)
+
+    # declare model
+    if args.export:
+        model = PopMusicTransformer(
+            checkpoint_path=None, dictionary_path=None, export_path=args.export, prompt_cache=prompt_cache)
+    else:
+        model = PopMusicTransformer(
+            checkpoint_path=args.checkpoint,
+            dictionary_path=args.dictionary,
+            is_training=False,
+            prompt_cache=prompt_cache)
+
+    scheduler = GenerationScheduler(
+        model, max_batch_size=args.max_batch_size, max_pending=args.max_pending,
+        request_timeout=args.request_timeout)
+    scheduler.start()
+    server = GenerationServer(('127.0.0.1', args.port), scheduler)
+    print(f"Serving on http://127.0.0.1:{args.port}/generate")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        scheduler.stop()
+        model.close()
+
+if __name__ == '__main__':
+    main()
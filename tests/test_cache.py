@@ -0,0 +1,33 @@
+import os
+import threading
+import numpy as np
+import cache
+
+
+def test_token_cache_concurrent_writers(tmp_path):
+    # files with the same content share a key and may be written at once
+    token_cache = cache.TokenCache(str(tmp_path))
+    errors = []
+
+    def write():
+        for _ in range(50):
+            try:
+                token_cache.put('abcdef', list(range(1000)))
+            except OSError as err:
+                errors.append(err)
+
+    threads = [threading.Thread(target=write) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert np.array_equal(token_cache.get('abcdef'), np.arange(1000))
+    assert os.listdir(str(tmp_path / 'ab')) == ['abcdef.npy']
+
+
+def test_prompt_cache_spills_to_disk(tmp_path):
+    prompt_cache = cache.PromptCache(max_bytes=0, cache_dir=str(tmp_path))
+    prompt_cache.put('key', {'words': np.arange(3)})
+    assert os.listdir(str(tmp_path)) == ['key.npz']
+    assert np.array_equal(prompt_cache.get('key')['words'], np.arange(3))
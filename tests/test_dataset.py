@@ -0,0 +1,75 @@
+import os
+import numpy as np
+import dataset
+
+EVENTS = ['Position_1/16', 'Note Velocity_20', 'Note Duration_0', 'Instrument_0', 'Instrument_128',
+          'Note On_36', 'Note On_37', 'Note On_38', 'Note On_39', 'Note On_60', 'Note On_61']
+EVENT2WORD = {event: word for word, event in enumerate(EVENTS)}
+
+
+def shift_table(step):
+    table = np.arange(len(EVENTS))
+    for event, word in EVENT2WORD.items():
+        if event.startswith('Note On_'):
+            table[word] = EVENT2WORD.get('Note On_{}'.format(int(event.split('_')[1]) + step), word)
+    return table
+
+
+def to_segments(events, group_size, x_len):
+    stream = np.array([EVENT2WORD[event] for event in events])
+    assert len(stream) == group_size * x_len + 1
+    return np.stack([stream[:-1].reshape(group_size, x_len), stream[1:].reshape(group_size, x_len)], axis=1)[None]
+
+
+def to_events(segments):
+    stream = np.concatenate([segments[0, :, 0, :].reshape(-1), segments[0, -1, 1, -1:]])
+    return [EVENTS[word] for word in stream]
+
+
+def test_transpose_segments_keeps_drums():
+    # the drum note's instrument is in the next group of the segment
+    events = ['Position_1/16', 'Position_1/16', 'Position_1/16', 'Note Velocity_20', 'Note On_36',
+              'Note Duration_0', 'Instrument_128', 'Note Velocity_20', 'Note On_60', 'Note Duration_0',
+              'Instrument_0', 'Note Velocity_20', 'Note On_38']
+    transposed = dataset.transpose_segments(to_segments(events, 2, 6), shift_table(1), EVENT2WORD)
+    expected = list(events)
+    expected[8] = 'Note On_61'
+    assert to_events(transposed) == expected
+
+
+def test_transpose_segments_keeps_note_ons_at_the_segment_end():
+    # a drum note at the end of the segment, its Instrument_128 is cut off
+    events = ['Note Velocity_20', 'Note On_60', 'Note Duration_0', 'Instrument_0',
+              'Note Velocity_20', 'Note On_36', 'Note Duration_0', 'Instrument_128',
+              'Position_1/16', 'Position_1/16', 'Note Velocity_20', 'Note On_36', 'Note Duration_0']
+    transposed = dataset.transpose_segments(to_segments(events, 3, 4), shift_table(1), EVENT2WORD)
+    expected = list(events)
+    expected[1] = 'Note On_61'
+    assert to_events(transposed) == expected
+
+
+def test_transpose_segments_keeps_x_and_y_aligned():
+    events = ['Note On_36', 'Note Duration_0', 'Instrument_0'] * 3
+    transposed = dataset.transpose_segments(to_segments(events[:-2], 1, 6), shift_table(2), EVENT2WORD)
+    assert np.array_equal(transposed[:, :, 0, 1:], transposed[:, :, 1, :-1])
+    assert to_events(transposed)[:4] == ['Note On_38', 'Note Duration_0', 'Instrument_0', 'Note On_38']
+
+
+class CrashingTokenizer(dataset.Tokenizer):
+    # word ids without reading files, and a worker that dies on 'crash' paths
+    def __init__(self):
+        pass
+
+    def extract_words(self, input_path, transposition_steps=0):
+        if input_path.startswith('crash'):
+            os._exit(1)
+        return list(range(len(input_path) * 10))
+
+
+def test_prepare_data_survives_dying_workers():
+    tokenizer = CrashingTokenizer()
+    paths = ['a', 'bb', 'crash', 'ccc', 'dddd', 'crash again', 'eeeee']
+    expected, _ = dataset.prepare_data([p for p in paths if not p.startswith('crash')], tokenizer, 4, 2, n_workers=1)
+    segments, errors = dataset.prepare_data(paths, tokenizer, 4, 2, n_workers=2, chunksize=2)
+    assert np.array_equal(segments, expected)
+    assert [path for path, _ in errors] == ['crash', 'crash again']
@@ -1,6 +1,7 @@
-import os
-import pretty_midi
-import music21
+import argparse
+import time
+import numpy as np
+import utils
 
 keys = {
     "A": 0,
@@ -19,15 +20,64 @@ keys = {
 
 inverted_keys = {v: k for k, v in keys.items()}
 
+# key names by pitch class (C = 0)
+PITCH_CLASSES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
 
-def find_key(midi_path):
+# Aarden-Essen key profiles, tonic first (music21's default for analyze('key'))
+MAJOR_PROFILE = np.array([17.7661, 0.145624, 14.9265, 0.160186, 19.8049, 11.3587,
+                          0.291248, 22.062, 0.145624, 8.15494, 0.232998, 4.95122])
+MINOR_PROFILE = np.array([18.2648, 0.737619, 14.0499, 16.8599, 0.702494, 14.4362,
+                          0.702494, 18.6161, 4.56621, 1.93186, 7.37619, 1.75623])
+
+
+def key_profiles():
+    # [24, 12]: the 12 major keys followed by the 12 minor keys, row i of
+    # each half is the profile rotated to tonic pitch class i
+    return np.array([np.roll(profile, tonic) for profile in [MAJOR_PROFILE, MINOR_PROFILE] for tonic in range(12)])
+
+
+def pitch_class_distribution(notes):
+    # duration-weighted pitch-class profile of the pitched notes (drums are left out)
+    if not isinstance(notes, utils.ItemArray):
+        notes = utils.ItemArray.from_items(notes)
+    pitched = notes.instrument != 128
+    pitch = notes.pitch[pitched].astype(np.int64)
+    duration = (notes.end - notes.start)[pitched]
+    return np.bincount(pitch % 12, weights=duration, minlength=12)
+
+
+# Krumhansl-Schmuckler: the key whose profile correlates best with the
+# pitch-class distribution. notes (Items or an ItemArray) are read from
+# midi_path when not given
+def find_key(midi_path=None, notes=None):
+    if notes is None:
+        notes, _ = utils.read_item_arrays(midi_path)
+    distribution = pitch_class_distribution(notes)
+    if not distribution.any():
+        return 'C', 'major'
+    profiles = key_profiles()
+    profiles = profiles - profiles.mean(axis=1, keepdims=True)
+    distribution = distribution - distribution.mean()
+    correlation = profiles.dot(distribution) / np.sqrt(
+        (profiles ** 2).sum(axis=1) * (distribution ** 2).sum())
+    best = int(np.argmax(correlation))
+    return PITCH_CLASSES[best % 12], 'major' if best < 12 else 'minor'
+
+
+# the key music21 finds (slow, parses the whole file again)
+def find_key_music21(midi_path):
+    import music21
     score = music21.converter.parse(midi_path)
     key = score.analyze('key')
-    return key.tonic.name.replace('-', ''), key.mode
+    return PITCH_CLASSES[key.tonic.pitchClass], key.mode
 
 
-def get_number_of_steps_for_transposition_to(midi_path, target_key):
-    key, mode = find_key(midi_path)
+def get_number_of_steps_for_transposition_to(midi_path, target_key, notes=None):
+    key, mode = find_key(midi_path, notes=notes)
+    return transposition_steps(key, mode, target_key)
+
+
+def transposition_steps(key, mode, target_key):
     key_nr = keys[key]
     target_key_nr = keys[target_key]
 
@@ -50,3 +100,39 @@ def get_number_of_steps_for_transposition_to(midi_path, target_key):
         transpose_steps = transpose_steps_up
 
     return transpose_steps
+
+
+def main():
+    # compare find_key with music21 on a set of midi files
+    parser = argparse.ArgumentParser(description='Compare key detection with music21.')
+    parser.add_argument('midi_paths', nargs='+')
+    args = parser.parse_args()
+
+    same_key, same_steps, compared = 0, 0, 0
+    fast_time, music21_time = 0.0, 0.0
+    for path in args.midi_paths:
+        try:
+            start = time.time()
+            notes, _ = utils.read_item_arrays(path)
+            key = find_key(path, notes=notes)
+            fast_time += time.time() - start
+            start = time.time()
+            reference = find_key_music21(path)
+            music21_time += time.time() - start
+        except Exception as e:
+            print(f"error processing {path}, error: {e}")
+            continue
+        compared += 1
+        same_key += key == reference
+        # what matters for transposition: the same steps to C major / A minor
+        same_steps += transposition_steps(key[0], key[1], 'C') == transposition_steps(
+            reference[0], reference[1], 'C')
+        print('{}: {} {}, music21: {} {}'.format(path, key[0], key[1], reference[0], reference[1]))
+    if compared:
+        print('same key: {}/{} ({:.1%}), same transposition: {}/{} ({:.1%})'.format(
+            same_key, compared, same_key / compared, same_steps, compared, same_steps / compared))
+        print('time per file: {:.4f}s, music21: {:.4f}s'.format(fast_time / compared, music21_time / compared))
+
+
+if __name__ == '__main__':
+    main()
@@ -28,86 +28,187 @@ class Item(object):
             self.name, self.start, self.end, self.velocity, self.pitch, self.instrument)
 
 
+# structure-of-arrays version of a list of Items, one numpy column per field.
+# missing end, velocity and instrument are stored as -1; pitch holds the chord
+# name for chords, so it becomes an object column when chords are mixed in
+class ItemArray(object):
+    def __init__(self, name, start, end=None, velocity=None, pitch=None, instrument=None):
+        self.start = np.asarray(start, dtype=np.int64)
+        n = len(self.start)
+        self.name = np.full(n, name, dtype=object) if isinstance(name, str) else np.asarray(name, dtype=object)
+        self.end = np.full(n, -1, dtype=np.int64) if end is None else np.asarray(end, dtype=np.int64)
+        self.velocity = np.full(n, -1, dtype=np.int64) if velocity is None else np.asarray(velocity, dtype=np.int64)
+        self.pitch = np.full(n, -1, dtype=np.int64) if pitch is None else np.asarray(pitch)
+        if self.pitch.dtype.kind not in 'iu':
+            self.pitch = self.pitch.astype(object)
+        self.instrument = np.full(n, -1, dtype=np.int64) if instrument is None else np.asarray(
+            instrument, dtype=np.int64)
+
+    @classmethod
+    def from_items(cls, items):
+        def value(x):
+            return -1 if x is None else x
+        return cls(
+            name=[item.name for item in items],
+            start=[item.start for item in items],
+            end=[value(item.end) for item in items],
+            velocity=[value(item.velocity) for item in items],
+            pitch=[value(item.pitch) for item in items],
+            instrument=[value(item.instrument) for item in items])
+
+    @classmethod
+    def concatenate(cls, arrays):
+        return cls(
+            name=np.concatenate([a.name for a in arrays]),
+            start=np.concatenate([a.start for a in arrays]),
+            end=np.concatenate([a.end for a in arrays]),
+            velocity=np.concatenate([a.velocity for a in arrays]),
+            pitch=np.concatenate([a.pitch for a in arrays]),
+            instrument=np.concatenate([a.instrument for a in arrays]))
+
+    def to_items(self):
+        def value(x):
+            return None if x == -1 else x
+        return [Item(name=name, start=start, end=value(end), velocity=value(velocity), pitch=pitch,
+                     instrument=value(instrument))
+                for name, start, end, velocity, pitch, instrument in zip(
+                    self.name.tolist(), self.start.tolist(), self.end.tolist(), self.velocity.tolist(),
+                    self.pitch.tolist(), self.instrument.tolist())]
+
+    def __len__(self):
+        return len(self.start)
+
+    def __getitem__(self, index):
+        # an int gives one Item, anything else (slice, indices, mask) an ItemArray
+        if isinstance(index, (int, np.integer)):
+            return self[[index]].to_items()[0]
+        return ItemArray(
+            name=self.name[index],
+            start=self.start[index],
+            end=self.end[index],
+            velocity=self.velocity[index],
+            pitch=self.pitch[index],
+            instrument=self.instrument[index])
+
+    def __iter__(self):
+        return iter(self.to_items())
+
+    def __add__(self, other):
+        return ItemArray.concatenate([self, other])
+
+    def __repr__(self):
+        return 'ItemArray(n={})'.format(len(self))
+
+
 # read notes and tempo changes from midi (assume there is only one track)
 def read_items(file_path, transposition_steps=0):
+    note_items, tempo_items = read_item_arrays(file_path, transposition_steps=transposition_steps)
+    return note_items.to_items(), tempo_items.to_items()
+
+
+# read_items as ItemArrays
+def read_item_arrays(file_path, transposition_steps=0):
     midi_obj = miditoolkit.midi.parser.MidiFile(file_path)
     # note
-    notes = []
-    note_items = []
-    for index, instrument in enumerate(midi_obj.instruments):
-        for note in instrument.notes:
-            notes.append({'note': note, 'instrument': 128 if instrument.is_drum else instrument.program})
-
-    notes.sort(key=lambda x: (x['note'].start, x['instrument'], x['note'].pitch))
-    for note in notes:
-        adjusted_pitch = note['note'].pitch
-        if note['instrument'] != 128:
-            adjusted_pitch += transposition_steps
-
-            # To prevent invalid pitches
-            if adjusted_pitch < 0:
-                adjusted_pitch += 12
-            if adjusted_pitch > 127:
-                adjusted_pitch -= 12
-
-        note_items.append(Item(
-            name='Note',
-            start=note['note'].start,
-            end=note['note'].end,
-            velocity=note['note'].velocity,
-            instrument=note['instrument'],
-            pitch=adjusted_pitch))
-    note_items.sort(key=lambda x: x.start)
+    start, end, velocity, pitch, instrument = [], [], [], [], []
+    for index, track in enumerate(midi_obj.instruments):
+        program = 128 if track.is_drum else track.program
+        for note in track.notes:
+            start.append(note.start)
+            end.append(note.end)
+            velocity.append(note.velocity)
+            pitch.append(note.pitch)
+            instrument.append(program)
+    start, end = np.array(start, dtype=np.int64), np.array(end, dtype=np.int64)
+    velocity, pitch = np.array(velocity, dtype=np.int64), np.array(pitch, dtype=np.int64)
+    instrument = np.array(instrument, dtype=np.int64)
+    order = np.lexsort((pitch, instrument, start))
+    note_items = ItemArray(
+        name='Note',
+        start=start[order],
+        end=end[order],
+        velocity=velocity[order],
+        pitch=pitch[order],
+        instrument=instrument[order])
+    note_items = transpose_items(note_items, transposition_steps)
     # tempo
-    tempo_items = []
-    for tempo in midi_obj.tempo_changes:
-        tempo_items.append(Item(
-            name='Tempo',
-            start=tempo.time,
-            end=None,
-            velocity=None,
-            pitch=int(tempo.tempo)))
-    tempo_items.sort(key=lambda x: x.start)
-    # expand to all beat
-    max_tick = tempo_items[-1].start
-    existing_ticks = {item.start: item.pitch for item in tempo_items}
+    tempo_start = np.array([tempo.time for tempo in midi_obj.tempo_changes], dtype=np.int64)
+    tempo_value = np.array([int(tempo.tempo) for tempo in midi_obj.tempo_changes], dtype=np.int64)
+    order = np.argsort(tempo_start, kind='stable')
+    tempo_start, tempo_value = tempo_start[order], tempo_value[order]
+    # expand to all beat: a beat takes the tempo set exactly on it (the last
+    # one if there are several), otherwise the tempo of the beat before it
+    max_tick = tempo_start[-1]
     wanted_ticks = np.arange(0, max_tick + 1, DEFAULT_RESOLUTION)
-    output = []
-    for tick in wanted_ticks:
-        if tick in existing_ticks:
-            output.append(Item(
-                name='Tempo',
-                start=tick,
-                end=None,
-                velocity=None,
-                pitch=existing_ticks[tick]))
-        else:
-            output.append(Item(
-                name='Tempo',
-                start=tick,
-                end=None,
-                velocity=None,
-                pitch=output[-1].pitch))
-    tempo_items = output
+    on_beat = tempo_start % DEFAULT_RESOLUTION == 0
+    tempo_start, tempo_value = tempo_start[on_beat], tempo_value[on_beat]
+    last = len(tempo_start) - 1 - np.unique(tempo_start[::-1], return_index=True)[1]
+    tempo_start, tempo_value = tempo_start[last], tempo_value[last]
+    index = np.searchsorted(tempo_start, wanted_ticks, side='right') - 1
+    # beats before the first tempo take the first tempo
+    tempo_items = ItemArray(
+        name='Tempo',
+        start=wanted_ticks,
+        pitch=tempo_value[np.maximum(index, 0)])
     return note_items, tempo_items
 
 
-# quantize items
-def quantize_items(items, ticks=120):
+# nearest multiple of ticks (ties go to the lower one), in one vectorized pass
+def round_to_grid(times, ticks):
+    return (2 * times + ticks - 1) // (2 * ticks) * ticks
+
+
+# shift the pitch of all but drum notes by steps, as a copy
+def transpose_items(items, steps):
+    if steps == 0:
+        return items
+    array = items if isinstance(items, ItemArray) else ItemArray.from_items(items)
+    pitch = array.pitch.astype(np.int64)
+    pitched = array.instrument != 128
+    pitch[pitched] += steps
+    # To prevent invalid pitches
+    pitch[pitched & (pitch < 0)] += 12
+    pitch[pitched & (pitch > 127)] -= 12
+    transposed = array[np.arange(len(array))]
+    transposed.pitch = pitch
+    return transposed if isinstance(items, ItemArray) else transposed.to_items()
+
+
+# quantize items: move every item so it starts on the nearest grid step of
+# the grid np.arange(0, items[-1].start, ticks), keeping its length.
+# with quantize_ends, ends are snapped to the grid on their own instead
+# (at least one step after the start)
+def quantize_items(items, ticks=120, quantize_ends=False):
+    array = items if isinstance(items, ItemArray) else ItemArray.from_items(items)
+    if len(array) == 0:
+        return items
     # grid
-    grids = np.arange(0, items[-1].start, ticks, dtype=int)
+    last = max((items[-1].start - 1) // ticks * ticks, 0)
     # process
-    for item in items:
-        index = np.argmin(abs(grids - item.start))
-        shift = grids[index] - item.start
-        item.start += shift
-        item.end += shift
+    start = np.minimum(round_to_grid(array.start, ticks), last)
+    if quantize_ends:
+        end = np.maximum(round_to_grid(array.end, ticks), start + ticks)
+    else:
+        end = array.end + start - array.start
+    if isinstance(items, ItemArray):
+        items.start, items.end = start, end
+        return items
+    for item, item_start, item_end in zip(items, start.tolist(), end.tolist()):
+        item.start = item_start
+        item.end = item_end
     return items
 
 
 # extract chord
 def extract_chords(items):
     method = chord_recognition.MIDIChord()
+    if isinstance(items, ItemArray):
+        chords = method.extract_arrays(items.start, items.end, items.pitch.astype(np.int64), items.velocity)
+        return ItemArray(
+            name='Chord',
+            start=[chord[0] for chord in chords],
+            end=[chord[1] for chord in chords],
+            pitch=np.array([chord[2].split('/')[0] for chord in chords], dtype=object))
     chords = method.extract(notes=items)
     output = []
     for chord in chords:
@@ -120,17 +221,24 @@ def extract_chords(items):
     return output
 
 
+# bar index for sorted item starts: bar i holds the items
+# bounds[i]:bounds[i + 1], items outside all bars are left out
+def bar_offsets(starts, max_time, ticks_per_bar=DEFAULT_RESOLUTION * 4):
+    downbeats = np.arange(0, max_time + ticks_per_bar, ticks_per_bar)
+    bounds = np.searchsorted(starts, downbeats, side='left')
+    return downbeats, bounds
+
+
 # group items
 def group_items(items, max_time, ticks_per_bar=DEFAULT_RESOLUTION * 4):
+    if isinstance(items, ItemArray):
+        items = items[np.argsort(items.start, kind='stable')].to_items()
     items.sort(key=lambda x: x.start)
-    downbeats = np.arange(0, max_time + ticks_per_bar, ticks_per_bar)
+    starts = np.array([item.start for item in items], dtype=np.int64)
+    downbeats, bounds = bar_offsets(starts, max_time, ticks_per_bar)
     groups = []
-    for db1, db2 in zip(downbeats[:-1], downbeats[1:]):
-        insiders = []
-        for item in items:
-            if (item.start >= db1) and (item.start < db2):
-                insiders.append(item)
-        overall = [db1] + insiders + [db2]
+    for db1, db2, i, j in zip(downbeats[:-1], downbeats[1:], bounds[:-1], bounds[1:]):
+        overall = [db1] + items[i:j] + [db2]
         groups.append(overall)
     return groups
 
@@ -225,7 +333,7 @@ def item2event(groups):
                 elif tempo < DEFAULT_TEMPO_INTERVALS[0].start:
                     tempo_style = Event('Tempo Class', item.start, 'slow', None)
                     tempo_value = Event('Tempo Value', item.start, 0, None)
-                elif tempo > DEFAULT_TEMPO_INTERVALS[2].stop:
+                elif tempo >= DEFAULT_TEMPO_INTERVALS[2].stop:
                     tempo_style = Event('Tempo Class', item.start, 'fast', None)
                     tempo_value = Event('Tempo Value', item.start, 59, None)
                 events.append(tempo_style)
@@ -233,6 +341,124 @@ def item2event(groups):
     return events
 
 
+# event to word; unknown velocities become the largest velocity in the
+# dictionary, any other unknown event is reported and skipped
+def events_to_words(events, event2word):
+    words = []
+    for event in events:
+        e = '{}_{}'.format(event.name, event.value)
+        if e in event2word:
+            words.append(event2word[e])
+        else:
+            # OOV
+            if event.name == 'Note Velocity':
+                # replace with max velocity based on our training data
+                words.append(event2word['Note Velocity_21'])
+            else:
+                # something is wrong
+                # you should handle it for your own purpose
+                print('something is wrong! {}'.format(e))
+    return words
+
+
+# everything the encoding depends on besides the dictionary; bump the version
+# when the encoding code changes so cached tokens are not reused
+ENCODING_VERSION = 2
+
+
+def encoding_params():
+    return {
+        'version': ENCODING_VERSION,
+        'velocity_bins': DEFAULT_VELOCITY_BINS.tolist(),
+        'fraction': DEFAULT_FRACTION,
+        'duration_bins': DEFAULT_DURATION_BINS.tolist(),
+        'tempo_intervals': [[r.start, r.stop] for r in DEFAULT_TEMPO_INTERVALS],
+        'resolution': DEFAULT_RESOLUTION}
+
+
+# items straight to word ids, the same words as item2event followed by
+# events_to_words. every event type has an id table (-1 for events missing
+# from the dictionary) and positions, velocities, durations and tempos are
+# binned for all items at once
+class REMIEncoder(object):
+    def __init__(self, event2word):
+        self.event2word = event2word
+        self.bar = event2word['Bar_None']
+        velocity_oov = event2word.get('Note Velocity_21', -1)
+        self.position = self.table('Position', ['{}/{}'.format(i + 1, DEFAULT_FRACTION)
+                                                for i in range(DEFAULT_FRACTION)])
+        self.velocity = np.array([event2word.get('Note Velocity_{}'.format(i), velocity_oov)
+                                  for i in range(len(DEFAULT_VELOCITY_BINS))])
+        self.pitch = self.table('Note On', range(128))
+        self.duration = self.table('Note Duration', range(len(DEFAULT_DURATION_BINS)))
+        self.tempo_class = self.table('Tempo Class', ['slow', 'mid', 'fast'])
+        self.tempo_value = self.table('Tempo Value', range(60))
+
+    def table(self, name, values):
+        return np.array([self.event2word.get('{}_{}'.format(name, value), -1) for value in values])
+
+    def lookup(self, name, values):
+        # ids of events with arbitrary values (instruments, chords)
+        unique, inverse = np.unique(values, return_inverse=True)
+        return self.table(name, unique.tolist())[inverse]
+
+    def encode(self, items, max_time, ticks_per_bar=DEFAULT_RESOLUTION * 4):
+        if not isinstance(items, ItemArray):
+            items = ItemArray.from_items(items)
+        items = items[np.argsort(items.start, kind='stable')]
+        downbeats, bounds = bar_offsets(items.start, max_time, ticks_per_bar)
+        items = items[bounds[0]:bounds[-1]]
+        bar = np.searchsorted(downbeats, items.start, side='right') - 1
+        is_note = items.name == 'Note'
+        is_chord = items.name == 'Chord'
+        is_tempo = items.name == 'Tempo'
+        # bars without notes are left out
+        has_note = np.bincount(bar[is_note], minlength=len(downbeats)) > 0
+        keep = has_note[bar]
+        items, bar = items[keep], bar[keep]
+        is_note, is_chord, is_tempo = is_note[keep], is_chord[keep], is_tempo[keep]
+
+        # token layout: a Bar before the first item of every bar, then per item
+        # a position followed by 4 note, 1 chord or 2 tempo tokens
+        first = np.ones(len(items), dtype=bool)
+        first[1:] = bar[1:] != bar[:-1]
+        lengths = first + 1 + 4 * is_note + is_chord + 2 * is_tempo
+        offsets = np.cumsum(lengths) - lengths + first
+        words = np.full(lengths.sum(), -1, dtype=np.int64)
+        words[offsets[first] - 1] = self.bar
+
+        # position
+        flags = downbeats[bar][:, None] + np.arange(DEFAULT_FRACTION) * (ticks_per_bar / DEFAULT_FRACTION)
+        words[offsets] = self.position[np.argmin(abs(flags - items.start[:, None]), axis=1)]
+        # note
+        notes = items[is_note]
+        at = offsets[is_note]
+        velocity_index = np.searchsorted(DEFAULT_VELOCITY_BINS, notes.velocity, side='right') - 1
+        words[at + 1] = self.velocity[velocity_index]
+        pitch = notes.pitch.astype(np.int64)
+        words[at + 2] = np.where((pitch >= 0) & (pitch < 128), self.pitch[pitch % 128], -1)
+        duration = notes.end - notes.start
+        words[at + 3] = self.duration[np.argmin(abs(DEFAULT_DURATION_BINS - duration[:, None]), axis=1)]
+        words[at + 4] = self.lookup('Instrument', notes.instrument)
+        # chord
+        if is_chord.any():
+            words[offsets[is_chord] + 1] = self.lookup('Chord', items.pitch[is_chord].astype(str))
+        # tempo
+        tempo = items.pitch[is_tempo].astype(np.int64)
+        intervals = DEFAULT_TEMPO_INTERVALS
+        tempo_class = np.searchsorted([intervals[1].start, intervals[2].start], tempo, side='right')
+        tempo_value = np.clip(tempo - np.array([r.start for r in intervals])[tempo_class], 0, 59)
+        at = offsets[is_tempo]
+        words[at + 1] = self.tempo_class[tempo_class]
+        words[at + 2] = self.tempo_value[tempo_value]
+
+        # OOV: something is wrong, you should handle it for your own purpose
+        missing = words < 0
+        if missing.any():
+            print('something is wrong! {} events are not in the dictionary'.format(missing.sum()))
+        return words[~missing]
+
+
 #############################################################################################
 # WRITE MIDI
 #############################################################################################
@@ -244,99 +470,113 @@ def word_to_event(words, word2event):
     return events
 
 
-def write_midi(words, word2event, output_path, prompt_path=None, bars_in_prompt=4):
-    events = word_to_event(words, word2event)
-    # get downbeat and note (no time)
-    temp_notes = []
-    temp_chords = []
-    temp_tempos = []
-    for i in range(len(events) - 3):
-        if events[i].name == 'Bar' and i > 0:
-            temp_notes.append('Bar')
-            temp_chords.append('Bar')
-            temp_tempos.append('Bar')
-        elif events[i].name == 'Position' and \
-                events[i + 1].name == 'Note Velocity' and \
-                events[i + 2].name == 'Note On' and \
-                events[i + 3].name == 'Note Duration' and \
-                events[i + 4].name == 'Instrument':
-
-            # start time and end time from position
-            position = int(events[i].value.split('/')[0]) - 1
-            # velocity
-            index = int(events[i + 1].value)
-            velocity = int(DEFAULT_VELOCITY_BINS[index])
-            # pitch
-            pitch = int(events[i + 2].value)
-            # duration
-            index = int(events[i + 3].value)
-            duration = DEFAULT_DURATION_BINS[index]
-            # instrument
-            instrument = int(events[i + 4].value)
-            # adding
-            temp_notes.append([position, velocity, pitch, duration, instrument])
-        elif events[i].name == 'Position' and events[i + 1].name == 'Chord':
-            position = int(events[i].value.split('/')[0]) - 1
-            temp_chords.append([position, events[i + 1].value])
-        elif events[i].name == 'Position' and \
-                events[i + 1].name == 'Tempo Class' and \
-                events[i + 2].name == 'Tempo Value':
-            position = int(events[i].value.split('/')[0]) - 1
-            if events[i + 1].value == 'slow':
-                tempo = DEFAULT_TEMPO_INTERVALS[0].start + int(events[i + 2].value)
-            elif events[i + 1].value == 'mid':
-                tempo = DEFAULT_TEMPO_INTERVALS[1].start + int(events[i + 2].value)
-            elif events[i + 1].value == 'fast':
-                tempo = DEFAULT_TEMPO_INTERVALS[2].start + int(events[i + 2].value)
-            temp_tempos.append([position, tempo])
-    # get specific time for notes
-    ticks_per_beat = DEFAULT_RESOLUTION
-    ticks_per_bar = DEFAULT_RESOLUTION * 4  # assume 4/4
+# word ids back to note, chord and tempo arrays: every word in the
+# dictionary gets an event type and a value, so a whole sequence is pattern
+# matched with array comparisons instead of event by event
+class REMIDecoder(object):
+    TYPES = ['Bar', 'Position', 'Note Velocity', 'Note On', 'Note Duration', 'Instrument', 'Chord',
+             'Tempo Class', 'Tempo Value']
+
+    def __init__(self, word2event):
+        self.word2event = word2event
+        n_token = max(word2event) + 1
+        # type 0 is any other event
+        self.type = np.zeros(n_token, dtype=np.int64)
+        self.value = np.zeros(n_token, dtype=np.int64)
+        self.chords = []
+        tempo_starts = {'slow': DEFAULT_TEMPO_INTERVALS[0].start,
+                        'mid': DEFAULT_TEMPO_INTERVALS[1].start,
+                        'fast': DEFAULT_TEMPO_INTERVALS[2].start}
+        for word, event in word2event.items():
+            event_name, event_value = event.split('_')
+            if event_name not in self.TYPES:
+                continue
+            try:
+                if event_name == 'Position':
+                    value = int(event_value.split('/')[0]) - 1
+                elif event_name == 'Note Velocity':
+                    value = int(DEFAULT_VELOCITY_BINS[int(event_value)])
+                elif event_name == 'Note Duration':
+                    value = int(DEFAULT_DURATION_BINS[int(event_value)])
+                elif event_name == 'Chord':
+                    value = len(self.chords)
+                    self.chords.append(event_value)
+                elif event_name == 'Tempo Class':
+                    value = tempo_starts[event_value]
+                elif event_name == 'Bar':
+                    value = 0
+                else:
+                    value = int(event_value)
+            except (ValueError, IndexError, KeyError):
+                # values that cannot be decoded, treat the word as any other event
+                continue
+            self.type[word] = self.TYPES.index(event_name) + 1
+            self.value[word] = value
+
+    def is_type(self, types, name):
+        return types == self.TYPES.index(name) + 1
+
+    # notes (start, end, pitch, velocity, instrument), chords (start, chord
+    # index) and tempos (start, bpm) as int arrays, in sequence order
+    def decode(self, words, first_bar=0, ticks_per_bar=DEFAULT_RESOLUTION * 4):
+        words = np.asarray(words, dtype=np.int64)
+        n = len(words)
+        # pad so every pattern can look 4 words ahead
+        types = np.concatenate([self.type[words], np.zeros(4, dtype=np.int64)])
+        values = np.concatenate([self.value[words], np.zeros(4, dtype=np.int64)])
+
+        # every Bar but a leading one starts the next bar
+        is_bar = self.is_type(types[:n], 'Bar')
+        is_bar[:1] = False
+        bar = first_bar + np.cumsum(is_bar)
+        # start time from bar and position
+        flags = np.arange(DEFAULT_FRACTION) * (ticks_per_bar / DEFAULT_FRACTION)
+        start = (bar * ticks_per_bar + flags[values[:n] % DEFAULT_FRACTION]).astype(np.int64)
+
+        is_position = self.is_type(types[:n], 'Position')
+        is_note = is_position & \
+            self.is_type(types[1:n + 1], 'Note Velocity') & \
+            self.is_type(types[2:n + 2], 'Note On') & \
+            self.is_type(types[3:n + 3], 'Note Duration') & \
+            self.is_type(types[4:n + 4], 'Instrument')
+        is_chord = is_position & self.is_type(types[1:n + 1], 'Chord')
+        is_tempo = is_position & \
+            self.is_type(types[1:n + 1], 'Tempo Class') & \
+            self.is_type(types[2:n + 2], 'Tempo Value')
+
+        i = np.where(is_note)[0]
+        notes = np.stack([start[i], start[i] + values[i + 3], values[i + 2], values[i + 1], values[i + 4]], axis=1)
+        i = np.where(is_chord)[0]
+        chords = np.stack([start[i], values[i + 1]], axis=1)
+        i = np.where(is_tempo)[0]
+        tempos = np.stack([start[i], values[i + 1] + values[i + 2]], axis=1)
+        return notes, chords, tempos
+
+
+# one decoder per dictionary
+decoders = {}
+
+
+def get_decoder(word2event):
+    decoder = decoders.get(id(word2event))
+    if decoder is None or decoder.word2event is not word2event:
+        decoder = REMIDecoder(word2event)
+        decoders[id(word2event)] = decoder
+    return decoder
+
+
+def words_to_items(words, word2event, first_bar=0):
+    decoder = get_decoder(word2event)
+    note_array, chord_array, tempo_array = decoder.decode(words, first_bar=first_bar)
     notes = {}
-    current_bar = 0
-    for note in temp_notes:
-        if note == 'Bar':
-            current_bar += 1
-        else:
-            position, velocity, pitch, duration, instrument = note
-            # position (start time)
-            current_bar_st = current_bar * ticks_per_bar
-            current_bar_et = (current_bar + 1) * ticks_per_bar
-            flags = np.linspace(current_bar_st, current_bar_et, DEFAULT_FRACTION, endpoint=False, dtype=int)
-            st = flags[position]
-            # duration (end time)
-            et = st + duration
-            notes.setdefault(instrument, []).append(miditoolkit.Note(velocity, pitch, st, et))
-    # get specific time for chords
-    if len(temp_chords) > 0:
-        chords = []
-        current_bar = 0
-        for chord in temp_chords:
-            if chord == 'Bar':
-                current_bar += 1
-            else:
-                position, value = chord
-                # position (start time)
-                current_bar_st = current_bar * ticks_per_bar
-                current_bar_et = (current_bar + 1) * ticks_per_bar
-                flags = np.linspace(current_bar_st, current_bar_et, DEFAULT_FRACTION, endpoint=False, dtype=int)
-                st = flags[position]
-                chords.append([st, value])
-    # get specific time for tempos
-    tempos = []
-    current_bar = 0
-    for tempo in temp_tempos:
-        if tempo == 'Bar':
-            current_bar += 1
-        else:
-            position, value = tempo
-            # position (start time)
-            current_bar_st = current_bar * ticks_per_bar
-            current_bar_et = (current_bar + 1) * ticks_per_bar
-            flags = np.linspace(current_bar_st, current_bar_et, DEFAULT_FRACTION, endpoint=False, dtype=int)
-            st = flags[position]
-            tempos.append([int(st), value])
-    # write
+    for st, et, pitch, velocity, instrument in note_array.tolist():
+        notes.setdefault(instrument, []).append(miditoolkit.Note(velocity, pitch, st, et))
+    chords = [[st, decoder.chords[index]] for st, index in chord_array.tolist()]
+    tempos = tempo_array.tolist()
+    return notes, chords, tempos
+
+
+def create_midi(notes, chords, tempos, prompt_path=None, bars_in_prompt=4):
     if prompt_path:
         midi = miditoolkit.midi.parser.MidiFile(prompt_path)
         last_time = DEFAULT_RESOLUTION * 4 * bars_in_prompt
@@ -364,10 +604,9 @@ def write_midi(words, word2event, output_path, prompt_path=None, bars_in_prompt=
                     existing_notes.setdefault(program, []).append(note)
 
         # write chord into marker
-        if len(temp_chords) > 0:
-            for c in chords:
-                new_midi.markers.append(
-                    miditoolkit.midi.containers.Marker(text=c[1], time=c[0] + last_time))
+        for c in chords:
+            new_midi.markers.append(
+                miditoolkit.midi.containers.Marker(text=c[1], time=c[0] + last_time))
 
         for instrument, instrument_notes in notes.items():
             program = 0 if instrument == 128 else instrument
@@ -379,14 +618,11 @@ def write_midi(words, word2event, output_path, prompt_path=None, bars_in_prompt=
 
             # note shift and add
             for note in instrument_notes:
-                note.start += last_time
-                note.end += last_time
-                inst.notes.append(note)
+                inst.notes.append(miditoolkit.Note(note.velocity, note.pitch,
+                                                   note.start + last_time, note.end + last_time))
 
             new_midi.instruments.append(inst)
-
-        # write
-        new_midi.dump(output_path)
+        return new_midi
     else:
         midi = miditoolkit.midi.parser.MidiFile()
         midi.ticks_per_beat = DEFAULT_RESOLUTION
@@ -398,18 +634,56 @@ def write_midi(words, word2event, output_path, prompt_path=None, bars_in_prompt=
         midi.tempo_changes = tempo_changes
 
         # write chord into marker
-        if len(temp_chords) > 0:
-            for c in chords:
-                midi.markers.append(
-                    miditoolkit.midi.containers.Marker(text=c[1], time=c[0]))
+        for c in chords:
+            midi.markers.append(
+                miditoolkit.midi.containers.Marker(text=c[1], time=c[0]))
 
         for instrument, instrument_notes in notes.items():
             program = 0 if instrument == 128 else instrument
             is_drum = True if instrument == 128 else False
             inst = miditoolkit.midi.containers.Instrument(program, is_drum=is_drum)
-            inst.notes = instrument_notes
+            inst.notes = list(instrument_notes)
             midi.instruments.append(inst)
+        return midi
 
-        # write
-        midi.dump(output_path)
+
+def write_midi(words, word2event, output_path, prompt_path=None, bars_in_prompt=4):
+    notes, chords, tempos = words_to_items(words, word2event)
+    midi = create_midi(notes, chords, tempos, prompt_path=prompt_path, bars_in_prompt=bars_in_prompt)
+    # write
+    midi.dump(output_path)
     print(f"Written midi to {output_path}")
+
+
+# collect a generated piece bar by bar, e.g. while streaming
+class MidiWriter(object):
+    def __init__(self, word2event, prompt_path=None, bars_in_prompt=4):
+        self.word2event = word2event
+        self.prompt_path = prompt_path
+        self.bars_in_prompt = bars_in_prompt
+        self.n_bars = 0
+        self.notes = {}
+        self.chords = []
+        self.tempos = []
+
+    # words of one bar (without Bar events); returns the notes of the bar as
+    # an array with columns start, end, pitch, velocity, instrument (in ticks
+    # from the start of the generated part)
+    def add_bar(self, words):
+        notes, chords, tempos = words_to_items(words, self.word2event, first_bar=self.n_bars)
+        self.n_bars += 1
+        bar_notes = []
+        for instrument, instrument_notes in notes.items():
+            self.notes.setdefault(instrument, []).extend(instrument_notes)
+            for note in instrument_notes:
+                bar_notes.append([note.start, note.end, note.pitch, note.velocity, instrument])
+        self.chords.extend(chords)
+        self.tempos.extend(tempos)
+        bar_notes.sort()
+        return np.array(bar_notes, dtype=int).reshape(-1, 5)
+
+    def write(self, output_path):
+        midi = create_midi(self.notes, self.chords, self.tempos,
+                           prompt_path=self.prompt_path, bars_in_prompt=self.bars_in_prompt)
+        midi.dump(output_path)
+        print(f"Written midi to {output_path}")